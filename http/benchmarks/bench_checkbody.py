@@ -0,0 +1,84 @@
+"""
+Micro-benchmark for HTTP.checkbody, comparing the previous ast.literal_eval
+normalization with the current one on JSON and Python literal bodies.
+
+Run from the http directory, with the app requirements installed:
+    python benchmarks/bench_checkbody.py [--sizes 1KB,1MB,50MB] [--repeat 3]
+
+ast.literal_eval takes minutes on the largest bodies, so the legacy and
+Python literal runs are skipped above --literal-max (default 5MB).
+"""
+import os
+import sys
+import ast
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import app
+
+SIZES = {
+    "1KB": 1024,
+    "64KB": 64*1024,
+    "1MB": 1024*1024,
+    "5MB": 5*1024*1024,
+    "50MB": 50*1024*1024,
+}
+
+def legacy_checkbody(body):
+    # The normalization used before the tiered one
+    if isinstance(body, str) and body.strip().startswith("{"):
+        return json.dumps(ast.literal_eval(body))
+
+    return body
+
+def make_body(size, literal=False):
+    item = {"id": 0, "name": "event", "tags": ["a", "b"], "score": 1.5}
+    if literal:
+        item["active"] = True
+
+    dump = str if literal else json.dumps
+    count = max(1, size // len(dump(item)))
+    return dump({"events": [dict(item, id=i) for i in range(count)]})
+
+def measure(func, body, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+
+    return best*1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--literal-max", default="5MB")
+    args = parser.parse_args()
+
+    http = app.HTTP(redis=None, logger=logging.getLogger("bench"))
+
+    print("%-6s %-8s %10s %10s %10s" % ("size", "body", "legacy_ms", "cold_ms", "cached_ms"))
+    for name in args.sizes.split(","):
+        for kind in ["json", "literal"]:
+            if kind == "literal" and SIZES[name] > SIZES[args.literal_max]:
+                continue
+
+            body = make_body(SIZES[name], literal=kind == "literal")
+
+            legacy = "-"
+            if SIZES[name] <= SIZES[args.literal_max]:
+                legacy = "%.2f" % measure(legacy_checkbody, body, args.repeat)
+
+            app.body_modes.clear()
+            cold = measure(http.checkbody, body, 1)
+            cached = measure(http.checkbody, body, args.repeat)
+            print("%-6s %-8s %10s %10.2f %10.2f" % (name, kind, legacy, cold, cached))
+
+if __name__ == "__main__":
+    main()
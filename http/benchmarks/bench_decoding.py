@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for HTTP.decode_body, comparing the CPU time of each decoding
+strategy on bodies without a declared charset.
+
+Run from the http directory, with the app requirements installed:
+    python benchmarks/bench_decoding.py [--sizes 1KB,1MB,100MB] [--repeat 3]
+
+Full charset detection can take minutes on the largest bodies, so detect is
+skipped above --detect-max (default 10MB).
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import app
+
+SIZES = {
+    "1KB": 1024,
+    "64KB": 64*1024,
+    "1MB": 1024*1024,
+    "10MB": 10*1024*1024,
+    "100MB": 100*1024*1024,
+}
+
+STRATEGIES = ["detect", "sample", "declared", "utf-8"]
+
+def make_response(size, charset="utf-8"):
+    # XML without a charset is one of the cases where requests runs detection
+    line = "<event id=\"1\" user=\"jürgen\" city=\"Zürich\">login</event>\n".encode(charset)
+    response = requests.models.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/xml"
+    response._content = (line * (size // len(line) + 1))[:size]
+    response._content_consumed = True
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        elapsed = time.process_time() - start
+        best = elapsed if best == None else min(best, elapsed)
+
+    return best*1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--detect-max", default="10MB")
+    args = parser.parse_args()
+
+    http = app.HTTP(redis=None, logger=logging.getLogger("bench"))
+
+    print("%-6s %-8s %s" % ("size", "charset", " ".join(["%12s" % ("%s_ms" % strategy) for strategy in STRATEGIES])))
+    for name in args.sizes.split(","):
+        for charset in ["utf-8", "latin-1"]:
+            response = make_response(SIZES[name], charset)
+
+            results = []
+            for strategy in STRATEGIES:
+                if strategy == "detect" and SIZES[name] > SIZES[args.detect_max]:
+                    results.append("%12s" % "-")
+                    continue
+
+                results.append("%12.2f" % measure(lambda: http.decode_body(response, strategy), args.repeat))
+
+            print("%-6s %-8s %s" % (name, charset, " ".join(results)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Benchmark suite for the HTTP app, running every verb, prepare_response,
+checkbody and return_file at realistic payload sizes against the local
+stand-in server in benchmarks/standin.py, which also emulates the files API.
+POST, PUT and PATCH send JSON object bodies, which go through checkbody, and
+checkbody runs on JSON and Python literal bodies without its mode cache.
+
+Run from the http directory, with the app requirements installed:
+    python benchmarks/bench_http.py [--sizes 1KB,1MB,10MB] [--repeat 20]
+        [--scenarios GET,POST,checkbody] [--json results.json]
+
+Each scenario and size runs in a forked process, so the peak RSS reported is
+its own. Latencies are wall time per call, and the throughput is the payload
+size over the time taken.
+
+Upstream traffic can be recorded to a cassette with
+    --cassette bench.ndjson --mode record
+and replayed from it with --mode replay, which takes the stand-in server's
+response times out of the numbers. The whole cassette is loaded in each
+process on replay, which adds to the peak RSS. The stand-in then listens on a fixed
+--port (default 18431), since exchanges are matched on the URL. The files
+API is always the stand-in.
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextlib
+import resource
+import subprocess
+import multiprocessing
+
+import urllib3
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+import app
+import standin
+
+SIZES = {
+    "1KB": 1024,
+    "64KB": 64*1024,
+    "1MB": 1024*1024,
+    "10MB": 10*1024*1024,
+    "100MB": 100*1024*1024,
+}
+
+SCENARIOS = ["GET", "GET_to_file", "HEAD", "DELETE", "OPTIONS", "POST", "PUT", "PATCH", "prepare_response", "checkbody", "checkbody_literal", "return_file"]
+
+CASSETTE_PORT = 18431
+
+FULL_EXECUTION = {
+    "execution_id": "bench",
+    "workflow": {"id": "bench", "execution_org": {"id": "bench"}},
+}
+
+def start_standin(port=0):
+    # The server runs in its own process, to keep it out of the measurements
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "standin.py"), "--port", str(port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+def make_instance(cls, url):
+    # The SDK prints on init, which would break up the tables
+    with contextlib.redirect_stdout(io.StringIO()):
+        http = cls(redis=None, logger=logging.getLogger("bench"))
+
+    http.url = url
+    http.authorization = "bench"
+    http.full_execution = json.dumps(FULL_EXECUTION)
+    return http
+
+def make_response(payload):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = "http://bench/payload"
+    response.headers["Content-Type"] = "application/json"
+    response._content = payload
+    response._content_consumed = True
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+def stream_response(payload):
+    # Same as a response from send_request with stream=True
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = "http://bench/payload"
+    response.headers["Content-Type"] = "application/json"
+    response.raw = urllib3.HTTPResponse(body=io.BytesIO(payload), headers={"Content-Type": "application/json"}, status=200, preload_content=False)
+    return response
+
+def make_op(http, scenario, url, size):
+    target = "%s/payload/%d" % (url, size)
+    payload = standin.make_payload(size)
+
+    # Request bodies are objects, as only those are normalized by checkbody
+    body = standin.make_object(size).decode("utf-8")
+
+    if scenario == "GET":
+        return lambda: http.GET(target)
+    if scenario == "GET_to_file":
+        return lambda: http.GET(target, to_file="true")
+    if scenario in ["HEAD", "DELETE", "OPTIONS"]:
+        return lambda: getattr(http, scenario)(target)
+    if scenario in ["POST", "PUT", "PATCH"]:
+        return lambda: getattr(http, scenario)("%s/echo" % url, body=body)
+    if scenario == "prepare_response":
+        response = make_response(payload)
+        return lambda: http.prepare_response(response)
+    if scenario in ["checkbody", "checkbody_literal"]:
+        # Without the cached mode of the body, so every call parses it
+        if scenario == "checkbody_literal":
+            body = standin.make_object(size, literal=True).decode("utf-8")
+
+        def op():
+            with app.body_modes_lock:
+                app.body_modes.clear()
+
+            return http.checkbody(body)
+
+        return op
+    if scenario == "return_file":
+        return lambda: http.return_file(stream_response(payload))
+
+    raise ValueError("Unknown scenario %s" % scenario)
+
+def check_result(result):
+    # The actions return JSON strings, and return_file a dict
+    if isinstance(result, str) and result.startswith("{"):
+        result = json.loads(result)
+
+    if isinstance(result, dict) and result.get("success") == False:
+        raise RuntimeError("Failed: %s" % json.dumps(result)[:200])
+
+def measure(op, repeat):
+    # The first call warms up connections and caches, and isn't counted
+    check_result(op())
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def peak_rss():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss*1024
+
+def run_isolated(func, *args):
+    # Runs func in a forked process, returning its result and peak RSS
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+
+    def child():
+        try:
+            queue.put(("ok", func(*args), peak_rss()))
+        except Exception as e:
+            queue.put(("error", "%s: %s" % (type(e).__name__, e), peak_rss()))
+
+    process = context.Process(target=child)
+    process.start()
+    status, result, rss = queue.get()
+    process.join()
+
+    if status != "ok":
+        raise RuntimeError(result)
+
+    return result, rss
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(percent / 100.0 * (len(values)-1))))]
+
+def summarize(latencies, size, rss):
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "p50_ms": percentile(latencies, 50)*1000,
+        "p99_ms": percentile(latencies, 99)*1000,
+        "calls_s": len(latencies) / total if total else 0,
+        "mb_s": size*len(latencies) / total / 1024 / 1024 if total else 0,
+        "peak_rss_mb": rss / 1024 / 1024,
+    }
+
+def print_row(columns, result):
+    if "error" in result:
+        print("%s  error: %s" % (" ".join(columns), result["error"]))
+        return
+
+    print("%s %10.2f %10.2f %10.1f %10.1f %12.1f" % (" ".join(columns), result["p50_ms"], result["p99_ms"], result["calls_s"], result["mb_s"], result["peak_rss_mb"]))
+
+def print_header(columns):
+    print("%s %10s %10s %10s %10s %12s" % (" ".join(columns), "p50_ms", "p99_ms", "calls/s", "MB/s", "peak_rss_MB"))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1KB,64KB,1MB,10MB")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--cassette", default="")
+    parser.add_argument("--mode", default="replay", choices=["record", "replay"])
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--json", default="")
+    args = parser.parse_args()
+
+    # Read by the app when it creates its sessions, so set before the forks
+    app.CASSETTE = args.cassette
+    app.CASSETTE_MODE = args.mode
+
+    # Cassettes are matched on the URL, so their runs use a fixed port
+    port = args.port
+    if port == None:
+        port = CASSETTE_PORT if args.cassette else 0
+
+    process, url = start_standin(port)
+    results = []
+    try:
+        print_header(["%-17s" % "scenario", "%-6s" % "size"])
+        for scenario in args.scenarios.split(","):
+            for name in args.sizes.split(","):
+                size = SIZES[name]
+                result = {"scenario": scenario, "size": name}
+                try:
+                    latencies, rss = run_isolated(lambda: measure(make_op(make_instance(app.HTTP, url), scenario, url, size), args.repeat))
+                    # HEAD has no body to count throughput on
+                    result.update(summarize(latencies, 0 if scenario == "HEAD" else size, rss))
+                except RuntimeError as e:
+                    result["error"] = str(e)
+
+                print_row(["%-17s" % scenario, "%-6s" % name], result)
+                results.append(result)
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    if args.json:
+        with open(args.json, "w") as tmp:
+            json.dump(results, tmp, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Cross-version benchmark for the HTTP app, running the same workload through
+the pinned versions in http-versions/ and the current one in http/src, to
+compare their latency and memory use.
+
+Run from the http directory, with the app requirements installed:
+    python benchmarks/bench_versions.py [--versions 1.0.0,1.3.0,1.4.0]
+        [--verbs GET,POST] [--sizes 1KB,64KB,1MB] [--bodies json,literal]
+        [--repeat 10] [--threshold 10] [--json results.json]
+
+Every version is loaded with the stubbed AppBase below instead of the SDK it
+was built for, so they all run against the same file upload code and the
+stand-in server in benchmarks/standin.py. The matrix is verbs x body sizes x
+to_file, where every verb gets a response of the size. POST, PUT and PATCH
+also send an object body of the size, once as JSON and once as a Python
+literal, as those go through checkbody: ast.literal_eval and json.dumps up to
+1.3.0, and validation in 1.4.0. The body mode cache of newer versions is
+cleared before each call, so every version parses every body. Combinations a
+version doesn't support are shown as n/a.
+
+A path regresses when its p50 latency or peak RSS is more than --threshold
+percent worse than in the previous version, and at least --min-ms or
+--min-rss-mb worse, so noise on the smallest numbers isn't flagged. The
+regressions are listed at the end, and the exit code is 1 when there are any.
+"""
+import os
+import re
+import sys
+import json
+import types
+import inspect
+import logging
+import argparse
+import contextlib
+import importlib.util
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTP_DIR = os.path.join(BENCH_DIR, "..")
+VERSIONS_DIR = os.path.join(HTTP_DIR, "..", "http-versions")
+
+VERBS = ["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"]
+BODY_VERBS = ["POST", "PUT", "PATCH"]
+BODIES = ["json", "literal"]
+
+class AppBase:
+    """
+    Enough of the SDK's AppBase for the apps to run outside of Shuffle. Files
+    are uploaded the same way as the SDK's set_files.
+    """
+    __version__ = None
+    app_name = None
+
+    def __init__(self, redis=None, logger=None, console_logger=None):
+        self.redis = redis
+        self.logger = logger if logger else logging.getLogger("bench")
+        self.console_logger = console_logger if console_logger else self.logger
+        self.url = ""
+        self.authorization = ""
+        self.full_execution = {}
+        self.proxy_config = {}
+
+    def set_files(self, infiles):
+        full_execution = self.full_execution
+        if isinstance(full_execution, str):
+            full_execution = json.loads(full_execution)
+
+        headers = {
+            "Authorization": "Bearer %s" % self.authorization,
+            "User-Agent": "Shuffle 1.1.0",
+        }
+
+        if not isinstance(infiles, list):
+            infiles = [infiles]
+
+        file_ids = []
+        for curfile in infiles:
+            create_path = "/api/v1/files/create?execution_id=%s" % full_execution["execution_id"]
+            data = {
+                "filename": curfile.get("filename", "unspecified"),
+                "workflow_id": full_execution["workflow"]["id"],
+                "org_id": full_execution["workflow"]["execution_org"]["id"],
+            }
+
+            ret = requests.post("%s%s" % (self.url, create_path), headers=headers, json=data, verify=False, proxies=self.proxy_config)
+            if ret.status_code != 200 or not ret.json().get("success"):
+                continue
+
+            file_id = ret.json()["id"]
+            upload_path = "/api/v1/files/%s/upload?execution_id=%s" % (file_id, full_execution["execution_id"])
+            files = {"shuffle_file": (data["filename"], curfile["data"])}
+            requests.post("%s%s" % (self.url, upload_path), files=files, headers=headers, verify=False, proxies=self.proxy_config)
+            file_ids.append(file_id)
+
+        return file_ids
+
+def install_sdk_stub():
+    # Older versions import AppBase from walkoff_app_sdk, newer from shuffle_sdk
+    shuffle_sdk = types.ModuleType("shuffle_sdk")
+    shuffle_sdk.AppBase = AppBase
+    walkoff_app_sdk = types.ModuleType("walkoff_app_sdk")
+    app_base = types.ModuleType("walkoff_app_sdk.app_base")
+    app_base.AppBase = AppBase
+    walkoff_app_sdk.app_base = app_base
+
+    sys.modules["shuffle_sdk"] = shuffle_sdk
+    sys.modules["walkoff_app_sdk"] = walkoff_app_sdk
+    sys.modules["walkoff_app_sdk.app_base"] = app_base
+
+# Has to be in place before bench_http imports the current app
+install_sdk_stub()
+sys.path.insert(0, BENCH_DIR)
+
+import bench_http
+import standin
+
+def app_version(path):
+    with open(os.path.join(path, "api.yaml")) as tmp:
+        match = re.search(r"^app_version:\s*(\S+)", tmp.read(), re.MULTILINE)
+
+    return match.group(1) if match else os.path.basename(os.path.normpath(path))
+
+def find_versions():
+    # The pinned versions and the current one, oldest first
+    paths = [os.path.join(VERSIONS_DIR, name) for name in os.listdir(VERSIONS_DIR)] if os.path.isdir(VERSIONS_DIR) else []
+    paths = [path for path in paths if os.path.isfile(os.path.join(path, "src", "app.py"))]
+    paths.append(HTTP_DIR)
+
+    versions = {app_version(path): os.path.join(path, "src", "app.py") for path in paths}
+    return dict(sorted(versions.items(), key=lambda item: [int(part) if part.isdigit() else 0 for part in item[0].split(".")]))
+
+def load_version(version, path):
+    # Loaded under its own name, so the versions don't replace each other
+    spec = importlib.util.spec_from_file_location("http_app_%s" % version.replace(".", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.HTTP
+
+def make_op(http, verb, url, size, to_file, body=""):
+    # None when the version doesn't have the parameters for this path
+    func = getattr(http, verb, None)
+    if not func:
+        return None
+
+    params = inspect.signature(func).parameters
+    kwargs = {}
+    if body:
+        if "body" not in params:
+            return None
+
+        kwargs["body"] = standin.make_object(size, literal=body == "literal").decode("utf-8")
+
+    if to_file:
+        if "to_file" not in params:
+            return None
+
+        kwargs["to_file"] = "true"
+
+    target = "%s/payload/%d" % (url, size)
+    # The versions aren't in sys.modules, so their body mode cache is reached
+    # through the globals of the method
+    namespace = func.__globals__
+
+    def op():
+        if "body_modes" in namespace:
+            with namespace["body_modes_lock"]:
+                namespace["body_modes"].clear()
+
+        return func(target, **kwargs)
+
+    return op
+
+def run_path(cls, verb, url, size, to_file, body, repeat):
+    # Older versions print on every call, which would break up the tables
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        op = make_op(bench_http.make_instance(cls, url), verb, url, size, to_file, body)
+        if not op:
+            return None
+
+        return bench_http.measure(op, repeat)
+
+def find_regressions(results, versions, threshold, min_ms, min_rss_mb):
+    regressions = []
+    for path, row in results.items():
+        previous = None
+        for version in versions:
+            current = row.get(version)
+            if not current or "error" in current:
+                continue
+
+            if previous:
+                for key, minimum in [("p50_ms", min_ms), ("peak_rss_mb", min_rss_mb)]:
+                    old, new = previous[1][key], current[key]
+                    if new - old > minimum and new > old * (1 + threshold / 100.0):
+                        regressions.append("%s %s: %s %.1f -> %.1f (+%.0f%%) since %s" % (version, path, key, old, new, (new / old - 1) * 100 if old else 0, previous[0]))
+
+            previous = (version, current)
+
+    return regressions
+
+def print_table(title, results, versions, key):
+    print("\n%s" % title)
+    print("%-28s %s" % ("path", " ".join(["%10s" % version for version in versions])))
+    for path, row in results.items():
+        cells = []
+        for version in versions:
+            result = row.get(version)
+            if not result:
+                cells.append("%10s" % "n/a")
+            elif "error" in result:
+                cells.append("%10s" % "error")
+            else:
+                cells.append("%10.2f" % result[key])
+
+        print("%-28s %s" % (path, " ".join(cells)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--versions", default="")
+    parser.add_argument("--verbs", default=",".join(VERBS))
+    parser.add_argument("--sizes", default="1KB,64KB,1MB")
+    parser.add_argument("--bodies", default=",".join(BODIES))
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=10)
+    parser.add_argument("--min-ms", type=float, default=1)
+    parser.add_argument("--min-rss-mb", type=float, default=2)
+    parser.add_argument("--json", default="")
+    args = parser.parse_args()
+
+    versions = find_versions()
+    if args.versions:
+        versions = {version: path for version, path in versions.items() if version in args.versions.split(",")}
+
+    classes = {version: load_version(version, path) for version, path in versions.items()}
+
+    process, url = bench_http.start_standin()
+    results = {}
+    errors = []
+    try:
+        for verb in args.verbs.split(","):
+            bodies = args.bodies.split(",") if verb in BODY_VERBS else [""]
+            for name, body, to_file in [(name, body, to_file) for name in args.sizes.split(",") for body in bodies for to_file in [False, True]]:
+                size = bench_http.SIZES[name]
+                path = " ".join([part for part in [verb, name, body, "to_file" if to_file else ""] if part])
+                results[path] = {}
+                for version, cls in classes.items():
+                    try:
+                        latencies, rss = bench_http.run_isolated(run_path, cls, verb, url, size, to_file, body, args.repeat)
+                    except RuntimeError as e:
+                        results[path][version] = {"error": str(e)}
+                        errors.append("%s %s: %s" % (version, path, e))
+                        continue
+
+                    if latencies != None:
+                        results[path][version] = bench_http.summarize(latencies, 0 if verb == "HEAD" else size, rss)
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    print_table("p50 latency (ms)", results, classes, "p50_ms")
+    print_table("p99 latency (ms)", results, classes, "p99_ms")
+    print_table("Peak RSS (MB)", results, classes, "peak_rss_mb")
+
+    if errors:
+        print("\nErrors:")
+        for error in errors:
+            print("  %s" % error)
+
+    regressions = find_regressions(results, list(classes), args.threshold, args.min_ms, args.min_rss_mb)
+    print("\nRegressions over %.0f%%:" % args.threshold)
+    for regression in regressions:
+        print("  %s" % regression)
+
+    if not regressions:
+        print("  none")
+
+    if args.json:
+        with open(args.json, "w") as tmp:
+            json.dump({"results": results, "regressions": regressions, "errors": errors}, tmp, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Local stand-in for upstream APIs and the Shuffle files API, used by the
+benchmarks instead of live servers.
+
+    <any method> /payload/<bytes>              JSON body of exactly that size
+    POST/PUT/PATCH <any other path>            reads the body, returns its size
+    POST /api/v1/files/create                  creates a file id
+    POST /api/v1/files/<id>/upload             reads the multipart upload
+    GET  /api/v1/files/<id>[/content]          file metadata and content
+
+Uploaded files are only kept as their size, and their content is returned as
+that many zero bytes. Run on its own to keep the server out of the measured
+process:
+    python benchmarks/standin.py [--port 0]
+which prints the URL it listens on.
+"""
+import re
+import sys
+import json
+import socket
+import threading
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+payloads = {}
+payloads_lock = threading.Lock()
+
+files = {}
+files_lock = threading.Lock()
+
+def make_payload(size):
+    # A list of events, padded to the exact size
+    with payloads_lock:
+        if size not in payloads:
+            event = json.dumps({"id": 0, "user": "jürgen", "action": "login", "source": "10.0.0.1", "tags": ["a", "b"]}, ensure_ascii=False).encode()
+            count = max(0, (size - 2) // (len(event) + 2))
+            body = b"[" + b", ".join([event] * count) + b"]"
+            if len(body) < size:
+                body = body[:-1] + b" " * (size - len(body)) + b"]"
+
+            payloads[size] = body
+
+        return payloads[size]
+
+def make_object(size, literal=False):
+    # A JSON object of events padded to the exact size, or the same as a Python
+    # literal, as request bodies going through checkbody. Without true, false
+    # and null, which versions up to 1.3.0 can't parse with ast.literal_eval
+    with payloads_lock:
+        key = ("literal" if literal else "object", size)
+        if key not in payloads:
+            item = {"id": 0, "user": "jürgen", "action": "login", "source": "10.0.0.1", "tags": ["a", "b"]}
+            event = (repr(item) if literal else json.dumps(item, ensure_ascii=False)).encode()
+            start, end = (b"{'events': [", b"]}") if literal else (b'{"events": [', b"]}")
+            count = max(0, (size - len(start) - len(end)) // (len(event) + 2))
+            body = start + b", ".join([event] * count)
+            payloads[key] = body + b" " * max(0, size - len(body) - len(end)) + end
+
+        return payloads[key]
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        # Headers and body are written separately, which would otherwise wait
+        # for the client's delayed ACK
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def read_body(self):
+        # Counts the body without keeping it
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if chunk == 0:
+                    self.rfile.readline()
+                    break
+
+                size += self.discard(chunk)
+                self.rfile.readline()
+        else:
+            size = self.discard(int(self.headers.get("Content-Length") or 0))
+
+        return size
+
+    def discard(self, size):
+        left = size
+        while left > 0:
+            data = self.rfile.read(min(left, 1024*1024))
+            if not data:
+                break
+
+            left -= len(data)
+
+        return size - left
+
+    def reply(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def reply_json(self, data, status=200):
+        self.reply(status, json.dumps(data).encode())
+
+    def handle_files(self, path):
+        if path == "/api/v1/files/create":
+            self.read_body()
+            with files_lock:
+                file_id = "file_%d" % len(files)
+                files[file_id] = 0
+
+            return self.reply_json({"success": True, "id": file_id})
+
+        match = re.match(r"/api/v1/files/([^/]+)(/upload|/content)?$", path)
+        if not match:
+            return self.reply_json({"success": False}, 404)
+
+        file_id, action = match.groups()
+        if action == "/upload":
+            with files_lock:
+                files[file_id] = self.read_body()
+
+            return self.reply_json({"success": True})
+
+        self.read_body()
+        if file_id not in files:
+            return self.reply_json({"success": False}, 404)
+
+        if action == "/content":
+            return self.reply(200, b"\0" * files[file_id], "application/octet-stream")
+
+        return self.reply_json({"success": True, "filename": "%s.bin" % file_id, "id": file_id})
+
+    def handle_any(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/api/v1/files"):
+            return self.handle_files(path)
+
+        received = self.read_body()
+        match = re.match(r"/payload/(\d+)$", path)
+        if match:
+            return self.reply(200, make_payload(int(match.group(1))))
+
+        if self.command in ["POST", "PUT", "PATCH"]:
+            return self.reply_json({"success": True, "method": self.command, "received": received})
+
+        self.reply_json({"success": False, "error": "Unknown path %s" % path}, 404)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = handle_any
+
+def serve(port=0):
+    # Runs the server in a thread, and returns it with its URL
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandinHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    server, url = serve(args.port)
+    print(url, flush=True)
+
+    try:
+        # Stops when the parent closes stdin
+        sys.stdin.read()
+    except KeyboardInterrupt:
+        pass
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,397 @@
+import os
 import time
+import io
 import json
 import ast
+import re
+import base64
+import uuid
+import hashlib
+import tempfile
 import random
+import shlex
 import socket
 import uncurl
 import asyncio
+import urllib3
 import requests
+import threading
+import concurrent.futures
 import subprocess
+import collections
+import http.cookiejar
+import urllib.parse
+import email.utils
+import csv
+import codecs
+import xml.etree.ElementTree
 
 from shuffle_sdk import AppBase
 
+# The SDK creates a new HTTP instance for every action, so sessions are kept
+# on module level to reuse keep-alive connections between actions.
+POOL_SIZE = int(os.getenv("SHUFFLE_HTTP_POOL_SIZE", "10"))
+POOL_MAX_SESSIONS = int(os.getenv("SHUFFLE_HTTP_POOL_MAX_SESSIONS", "50"))
+POOL_IDLE_TIMEOUT = int(os.getenv("SHUFFLE_HTTP_POOL_IDLE_TIMEOUT", "300"))
+
+session_pool = collections.OrderedDict()
+session_pool_lock = threading.Lock()
+
+# Upstream exchanges are recorded to the SHUFFLE_HTTP_CASSETTE file with
+# SHUFFLE_HTTP_CASSETTE_MODE=record, and served from it without the network
+# with replay, e.g. for benchmarks. SHUFFLE_HTTP_CASSETTE_LATENCY=true waits
+# the recorded time before returning a replayed response.
+CASSETTE = os.getenv("SHUFFLE_HTTP_CASSETTE", "")
+CASSETTE_MODE = os.getenv("SHUFFLE_HTTP_CASSETTE_MODE", "replay").lower()
+CASSETTE_LATENCY = os.getenv("SHUFFLE_HTTP_CASSETTE_LATENCY", "false").lower() == "true"
+
+cassettes = {}
+cassettes_lock = threading.Lock()
+
+# Streamed downloads stay in memory up to this size before going to disk
+STREAM_CHUNK_SIZE = 1024*1024
+STREAM_SPOOL_SIZE = int(os.getenv("SHUFFLE_HTTP_SPOOL_SIZE", str(10*1024*1024)))
+
+# Retries are used for rate limits and unavailable upstreams, with the delay
+# growing exponentially from SHUFFLE_HTTP_RETRY_BACKOFF seconds
+RETRY_STATUSES = [429, 502, 503, 504]
+RETRY_BACKOFF = float(os.getenv("SHUFFLE_HTTP_RETRY_BACKOFF", "1"))
+RETRY_MAX_DELAY = float(os.getenv("SHUFFLE_HTTP_RETRY_MAX_DELAY", "30"))
+
+# The circuit breaker fails fast for a host after too many failures in a row,
+# until the cooldown is over. Shared through redis when available.
+BREAKER_THRESHOLD = int(os.getenv("SHUFFLE_HTTP_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = int(os.getenv("SHUFFLE_HTTP_BREAKER_COOLDOWN", "30"))
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+# Recent latencies per host, used to hedge requests and for adaptive timeouts. Kept in redis when
+# available, and in process otherwise. Percentiles need LATENCY_MIN_SAMPLES.
+LATENCY_SAMPLES = int(os.getenv("SHUFFLE_HTTP_LATENCY_SAMPLES", "200"))
+LATENCY_MIN_SAMPLES = int(os.getenv("SHUFFLE_HTTP_LATENCY_MIN_SAMPLES", "20"))
+HEDGE_PERCENTILE = float(os.getenv("SHUFFLE_HTTP_HEDGE_PERCENTILE", "95"))
+
+# timeout=adaptive uses the p99 latency of the host times the factor as the
+# read timeout, and the median times the factor as the connect timeout, within
+# the bounds. The connect timeout never goes over the cold bound, which is
+# used for both until the host has enough samples.
+ADAPTIVE_TIMEOUT_FACTOR = float(os.getenv("SHUFFLE_HTTP_ADAPTIVE_TIMEOUT_FACTOR", "3"))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("SHUFFLE_HTTP_ADAPTIVE_TIMEOUT_MIN", "1"))
+ADAPTIVE_TIMEOUT_MAX = float(os.getenv("SHUFFLE_HTTP_ADAPTIVE_TIMEOUT_MAX", "30"))
+ADAPTIVE_TIMEOUT_COLD = float(os.getenv("SHUFFLE_HTTP_ADAPTIVE_TIMEOUT_COLD", "5"))
+
+latency_history = {}
+latency_history_lock = threading.Lock()
+
+# How bodies without a declared charset are decoded: declared, utf-8, sample
+# or detect. sample only runs charset detection on DECODING_SAMPLE_SIZE bytes.
+DECODING = os.getenv("SHUFFLE_HTTP_DECODING", "sample").lower()
+DECODING_SAMPLE_SIZE = int(os.getenv("SHUFFLE_HTTP_DECODING_SAMPLE_SIZE", str(64*1024)))
+
+# Responses cached with cache=true. Stored in redis when available, and in
+# an in-process LRU otherwise. Entries are kept for revalidation after
+# max-age runs out, until SHUFFLE_HTTP_CACHE_TTL.
+CACHE_SIZE = int(os.getenv("SHUFFLE_HTTP_CACHE_SIZE", "100"))
+CACHE_TTL = int(os.getenv("SHUFFLE_HTTP_CACHE_TTL", "86400"))
+CACHE_MAX_BODY = int(os.getenv("SHUFFLE_HTTP_CACHE_MAX_BODY", str(5*1024*1024)))
+
+response_cache = collections.OrderedDict()
+response_cache_lock = threading.Lock()
+
+# GET with diff_against_last stores the hash of the last body, and a snapshot
+# of it when it is JSON, next to the cached responses. DIFF_MAX_CHANGES caps
+# the changes listed in one diff.
+DIFF_TTL = int(os.getenv("SHUFFLE_HTTP_DIFF_TTL", str(7*86400)))
+DIFF_MAX_CHANGES = 100
+
+# Responses over SHUFFLE_HTTP_MAX_INLINE_BYTES are spilled to a Shuffle file
+# with only a preview in the result, and responses over
+# SHUFFLE_HTTP_MAX_RESPONSE_BYTES are aborted. 0 turns either off.
+MAX_INLINE_BYTES = int(os.getenv("SHUFFLE_HTTP_MAX_INLINE_BYTES", "0"))
+MAX_RESPONSE_BYTES = int(os.getenv("SHUFFLE_HTTP_MAX_RESPONSE_BYTES", "0"))
+PREVIEW_BYTES = 4096
+
+# Ranged downloads with download_parts split the file in parts of at least
+# RANGE_MIN_PART_SIZE, and resume an interrupted part up to RANGE_ATTEMPTS times
+RANGE_MIN_PART_SIZE = int(os.getenv("SHUFFLE_HTTP_RANGE_MIN_PART_SIZE", str(8*1024*1024)))
+RANGE_MAX_PARTS = 16
+RANGE_ATTEMPTS = 3
+
+# BULK_POST returns at most this many record errors, along with the counts
+BULK_MAX_ERRORS = 100
+
+# String bodies starting with "{" are normalized to JSON. The detected mode
+# (json, literal or raw) is cached by digest so repeated bodies skip parsing.
+BODY_MODE_CACHE_SIZE = int(os.getenv("SHUFFLE_HTTP_BODY_CACHE_SIZE", "256"))
+BODY_MODE_MAX_CONVERTED = 64*1024
+
+body_object = re.compile(r"\s*\{")
+body_modes = collections.OrderedDict()
+body_modes_lock = threading.Lock()
+
+# Placeholders in TEMPLATE_FANOUT, written as ${name} so they don't clash
+# with Shuffle's own {{ }} and $node references
+template_placeholder = re.compile(r"\$\{\s*([^${}\s]+)\s*\}")
+
+# Connection timings for timing=true, recorded by the connection classes for
+# the request running in the current thread
+connection_timings = threading.local()
+
+class TimedConnectionMixin:
+    """
+    Records DNS, TCP connect and TLS handshake time for new connections.
+    Connections reused from the pool record nothing.
+    """
+    def _new_conn(self):
+        record = getattr(connection_timings, "record", None)
+        if record == None:
+            return super()._new_conn()
+
+        # Resolves the host separately to time it, then tries each address in
+        # turn, as urllib3 would when resolving it itself
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys([address[4][0] for address in addresses]))
+        except socket.gaierror:
+            addresses = []
+
+        record["dns"] = time.perf_counter() - start
+        # Unresolved hosts are left to urllib3, which reports the error
+        addresses = addresses or [host]
+        try:
+            for index, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    conn = super()._new_conn()
+                    break
+                except urllib3.exceptions.ConnectTimeoutError:
+                    # Covers NewConnectionError too
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+
+        record["connect"] = time.perf_counter() - start - record["dns"]
+        return conn
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+
+        # Everything after the TCP connect is the TLS handshake (and proxy tunnel)
+        record = getattr(connection_timings, "record", None)
+        if record != None and "connect" in record:
+            record["tls"] = max(0, time.perf_counter() - start - record["dns"] - record["connect"])
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes_by_scheme
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if isinstance(manager, urllib3.ProxyManager):
+            manager.pool_classes_by_scheme = self.pool_classes_by_scheme
+
+        return manager
+
+class Cassette:
+    """
+    Exchanges recorded to a file, one JSON object per line. Replays return the
+    responses recorded for the same method, URL and body in the recorded
+    order, and keep returning the last one after that.
+    """
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        self.positions = {}
+
+        if mode == "replay":
+            with open(path) as tmp:
+                for line in tmp:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        key = (exchange["method"], exchange["url"], exchange["body_sha256"])
+                        self.exchanges.setdefault(key, []).append(exchange)
+
+    @staticmethod
+    def digest(body):
+        # Streamed bodies are matched on the method and URL only
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        if isinstance(body, bytes):
+            return hashlib.sha256(body).hexdigest()
+
+        return ""
+
+    def record(self, exchange):
+        with self.lock:
+            with open(self.path, "a") as tmp:
+                tmp.write(json.dumps(exchange) + "\n")
+
+    def replay(self, method, url, digest):
+        key = (method, url, digest)
+        with self.lock:
+            exchanges = self.exchanges.get(key)
+            if not exchanges:
+                return None
+
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            return exchanges[min(position, len(exchanges)-1)]
+
+def get_cassette(path, mode):
+    with cassettes_lock:
+        if (path, mode) not in cassettes:
+            cassettes[(path, mode)] = Cassette(path, mode)
+
+        return cassettes[(path, mode)]
+
+class CassetteAdapter(TimedHTTPAdapter):
+    """
+    Records every exchange to a cassette, or replays them from it. Recorded
+    bodies are kept as sent, so replays go through the same decompression
+    and decoding as live responses.
+    """
+    def __init__(self, cassette, latency=False, **kwargs):
+        self.cassette = cassette
+        self.latency = latency
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        digest = Cassette.digest(request.body)
+        if self.cassette.mode == "replay":
+            exchange = self.cassette.replay(request.method, request.url, digest)
+            if not exchange:
+                raise requests.exceptions.ConnectionError("No recorded response for %s %s in %s" % (request.method, request.url, self.cassette.path), request=request)
+
+            if self.latency:
+                time.sleep(exchange["elapsed"])
+
+            return self.exchange_response(request, exchange)
+
+        # The whole body is read to record it, so endless streams can't be recorded
+        start = time.perf_counter()
+        response = super().send(request, stream=True, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        try:
+            body = response.raw.read(decode_content=False)
+        finally:
+            response.close()
+
+        exchange = {
+            "method": request.method,
+            "url": request.url,
+            "body_sha256": digest,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": list(response.raw.headers.items()),
+            "body": base64.b64encode(body).decode(),
+            "elapsed": time.perf_counter() - start,
+        }
+
+        self.cassette.record(exchange)
+        return self.exchange_response(request, exchange)
+
+    def exchange_response(self, request, exchange):
+        # The body is replayed whole, so it is no longer chunked
+        headers = urllib3.HTTPHeaderDict([(key, value) for key, value in exchange["headers"] if key.lower() != "transfer-encoding"])
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(base64.b64decode(exchange["body"])),
+            headers=headers,
+            status=exchange["status"],
+            reason=exchange["reason"],
+            preload_content=False,
+            decode_content=True,
+            request_method=request.method,
+            request_url=request.url,
+        )
+
+        return self.build_response(request, raw)
+
+# Identical GETs with coalesce_window share one upstream request, while it is
+# in flight and for the window after. Shared through redis when available.
+inflight_requests = {}
+inflight_lock = threading.Lock()
+
+class ResponseTooLarge(Exception):
+    pass
+
+class RangeNotSupported(Exception):
+    pass
+
+class SpooledFile:
+    """
+    Temporary file kept in memory up to STREAM_SPOOL_SIZE, which tracks the
+    size and sha256 of what is written to it.
+    """
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+class MultipartFile:
+    """
+    File-like multipart/form-data body which reads the file as it is sent,
+    so uploads don't have to be loaded into memory.
+    """
+    def __init__(self, fieldname, filename, fileobj, size):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % boundary
+
+        head = (
+            "--%s\r\n"
+            "Content-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ) % (boundary, fieldname, filename)
+        tail = "\r\n--%s--\r\n" % boundary
+
+        self.parts = [io.BytesIO(head.encode()), fileobj, io.BytesIO(tail.encode())]
+        self.length = len(head.encode()) + size + len(tail.encode())
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b""
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.pop(0)
+                continue
+
+            data += chunk
+
+        return data
+
 class HTTP(AppBase):
     __version__ = "1.4.0"
     app_name = "http"  
@@ -24,10 +406,112 @@ class HTTP(AppBase):
         """
         super().__init__(redis, logger, console_logger)
 
+    def parse_curl(self, statement):
+        # Returns None for anything which needs the shell or isn't supported,
+        # such as pipes, variables, files and unknown flags
+        if re.search(r"[`]|\$[({A-Za-z_]", statement):
+            return None
+
+        try:
+            lexer = shlex.shlex(statement, posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            tokens = list(lexer)
+        except ValueError:
+            return None
+
+        if len(tokens) < 2 or tokens[0] != "curl":
+            return None
+
+        verify = True
+        follow = False
+        auth = None
+        data_count = 0
+        remaining = ["curl"]
+
+        index = 1
+        while index < len(tokens):
+            token = tokens[index]
+            if re.match(r"^[|;&<>()]+$", token):
+                return None
+
+            if re.match(r"^-[sSLk]+$", token):
+                verify = verify and "k" not in token
+                follow = follow or "L" in token
+            elif token in ["--silent", "--show-error"]:
+                pass
+            elif token == "--insecure":
+                verify = False
+            elif token == "--location":
+                follow = True
+            elif token in ["-u", "--user"] and index+1 < len(tokens):
+                username, _, password = tokens[index+1].partition(":")
+                auth = requests.auth.HTTPBasicAuth(username, password)
+                index += 1
+            elif token in ["-X", "--request"] and index+1 < len(tokens):
+                remaining += ["-X", tokens[index+1]]
+                index += 1
+            elif token.startswith("-X") and len(token) > 2:
+                remaining += ["-X", token[2:]]
+            elif token in ["-H", "--header"] and index+1 < len(tokens):
+                remaining += ["-H", tokens[index+1]]
+                index += 1
+            elif token in ["-d", "--data", "--data-raw", "--data-binary"] and index+1 < len(tokens):
+                if token != "--data-raw" and tokens[index+1].startswith("@"):
+                    return None
+
+                data_count += 1
+                remaining += ["--data", tokens[index+1]]
+                index += 1
+            elif token == "--compressed":
+                remaining.append(token)
+            elif token.startswith("-"):
+                return None
+            else:
+                remaining.append(token)
+
+            index += 1
+
+        if data_count > 1:
+            return None
+
+        try:
+            context = uncurl.parse_context(shlex.join(remaining))
+        except (SystemExit, Exception):
+            return None
+
+        headers = dict(context.headers)
+        if not any(key.lower() == "user-agent" for key in headers):
+            headers["User-Agent"] = "Shuffle Automation"
+
+        # Same default as curl for -d
+        if context.data and not any(key.lower() == "content-type" for key in headers):
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        return {
+            "method": context.method.upper(),
+            "url": self.fix_url(context.url),
+            "headers": headers,
+            "cookies": dict(context.cookies),
+            "data": context.data,
+            "auth": auth,
+            "verify": verify,
+            "allow_redirects": follow,
+        }
+
     # This is dangerously fun :)
     # Do we care about arbitrary code execution here?
     # Probably not huh
-    def curl(self, statement):
+    def curl(self, statement, engine="shell"):
+        # The native engine runs the request in-process on the pooled sessions,
+        # and falls back to the shell for anything it can't parse
+        if str(engine).lower().strip() == "native":
+            parsed_curl = self.parse_curl(statement.strip())
+            if parsed_curl:
+                request = self.send_request(**parsed_curl)
+                return self.prepare_response(request)
+
+            self.logger.info("Running curl in a shell, as the statement isn't supported by the native engine")
+
         process = subprocess.Popen(statement, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
         stdout = process.communicate()
         item = ""
@@ -84,20 +568,10 @@ class HTTP(AppBase):
     def checkbody(self, body):
         # Indicates json
         if isinstance(body, str):
-            if body.strip().startswith("{"):
-                body = json.dumps(ast.literal_eval(body))
+            if body_object.match(body):
+                return self.normalize_body(body)
 
-
-                # Not sure if loading is necessary
-                # Seemed to work with plain string into data=body too, and not parsed json=body
-                #try:
-                #    body = json.loads(body)
-                #except json.decoder.JSONDecodeError as e:
-                #    return body
-
-                return body
-            else:
-                return body
+            return body
 
         if isinstance(body, dict) or isinstance(body, list):
             try:
@@ -107,6 +581,58 @@ class HTTP(AppBase):
 
         return body
 
+    def normalize_body(self, body):
+        """
+        Bodies which already are JSON are only validated and sent as their
+        UTF-8 bytes, so they don't depend on how urllib3 encodes strings.
+        Python literals (single quotes, True/None) are converted to JSON, and
+        anything else is sent untouched. The detected mode is cached by digest,
+        so repeated bodies skip the parsing.
+        """
+        digest = hashlib.blake2b(body.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with body_modes_lock:
+            cached = body_modes.get(digest)
+            if cached != None:
+                body_modes.move_to_end(digest)
+
+        if cached != None:
+            mode, converted = cached
+            if mode == "json":
+                return body.encode("utf-8")
+            if mode == "raw":
+                return body
+            if converted != None:
+                return converted
+
+        converted = None
+        if cached == None:
+            try:
+                json.loads(body)
+                mode = "json"
+            except ValueError:
+                mode = "literal"
+
+        if mode == "literal":
+            try:
+                converted = json.dumps(ast.literal_eval(body))
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                mode = "raw"
+
+        # Only small conversions are kept, large ones only remember the mode
+        kept = converted if converted != None and len(converted) <= BODY_MODE_MAX_CONVERTED else None
+        with body_modes_lock:
+            body_modes[digest] = (mode, kept)
+            body_modes.move_to_end(digest)
+            while len(body_modes) > BODY_MODE_CACHE_SIZE:
+                body_modes.popitem(last=False)
+
+        if mode == "literal":
+            return converted
+        if mode == "json":
+            return body.encode("utf-8")
+
+        return body
+
     def fix_url(self, url):
         # Random bugs seen by users
         if "hhttp" in url:
@@ -125,7 +651,1076 @@ class HTTP(AppBase):
 
         return url
 
-    def return_file(self, requestdata):
+    def get_session(self, url, verify=True, proxies=None):
+        parsedurl = urllib.parse.urlsplit(url)
+        if not proxies:
+            proxies = {}
+
+        key = (parsedurl.scheme.lower(), parsedurl.netloc.lower(), verify, tuple(sorted(proxies.items())))
+        now = time.time()
+        with session_pool_lock:
+            for oldkey in list(session_pool.keys()):
+                if now - session_pool[oldkey][1] > POOL_IDLE_TIMEOUT:
+                    session_pool.pop(oldkey)[0].close()
+
+            if key in session_pool:
+                session = session_pool[key][0]
+                session_pool.move_to_end(key)
+            else:
+                while len(session_pool) >= POOL_MAX_SESSIONS:
+                    session_pool.popitem(last=False)[1][0].close()
+
+                session = requests.Session()
+                if CASSETTE:
+                    adapter = CassetteAdapter(get_cassette(CASSETTE, CASSETTE_MODE), CASSETTE_LATENCY, pool_connections=1, pool_maxsize=POOL_SIZE)
+                else:
+                    adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                # Cookies should not leak from one action to the next
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+            session_pool[key] = (session, now)
+
+        return session
+
+    def set_metadata(self, request, key, value):
+        if not hasattr(request, "shuffle_metadata"):
+            request.shuffle_metadata = {}
+
+        request.shuffle_metadata[key] = value
+
+    def get_breaker(self, host):
+        key = "shuffle_http_breaker_%s" % host
+        if self.redis:
+            try:
+                state = self.redis.get(key)
+                if state:
+                    return json.loads(state)
+
+                return {"failures": 0, "opened_at": 0}
+            except Exception as e:
+                self.logger.info("Failed getting circuit breaker from redis: %s" % e)
+
+        with circuit_breakers_lock:
+            return dict(circuit_breakers.get(key, {"failures": 0, "opened_at": 0}))
+
+    def set_breaker(self, host, state):
+        key = "shuffle_http_breaker_%s" % host
+        if self.redis:
+            try:
+                self.redis.set(key, json.dumps(state), ex=BREAKER_COOLDOWN*10)
+                return
+            except Exception as e:
+                self.logger.info("Failed setting circuit breaker in redis: %s" % e)
+
+        with circuit_breakers_lock:
+            circuit_breakers[key] = state
+
+    def breaker_open(self, host):
+        state = self.get_breaker(host)
+        return state["failures"] >= BREAKER_THRESHOLD and time.time() - state["opened_at"] < BREAKER_COOLDOWN
+
+    def breaker_result(self, host, success):
+        state = self.get_breaker(host)
+        if success:
+            if state["failures"] > 0:
+                self.set_breaker(host, {"failures": 0, "opened_at": 0})
+
+            return
+
+        # Opens again after a failed try once the cooldown is over
+        state["failures"] += 1
+        if state["failures"] >= BREAKER_THRESHOLD:
+            state["opened_at"] = time.time()
+
+        self.set_breaker(host, state)
+
+    def retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(RETRY_MAX_DELAY, max(0, float(retry_after)))
+            except ValueError:
+                try:
+                    retry_date = email.utils.parsedate_to_datetime(retry_after)
+                    return min(RETRY_MAX_DELAY, max(0, retry_date.timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BACKOFF * (2 ** attempt)))
+
+    def record_latency(self, host, seconds):
+        key = "shuffle_http_latency_%s" % host
+        if self.redis:
+            try:
+                pipeline = self.redis.pipeline()
+                pipeline.lpush(key, round(seconds, 4))
+                pipeline.ltrim(key, 0, LATENCY_SAMPLES-1)
+                pipeline.expire(key, 86400)
+                pipeline.execute()
+                return
+            except Exception as e:
+                self.logger.info("Failed setting latency in redis: %s" % e)
+
+        with latency_history_lock:
+            if key not in latency_history:
+                latency_history[key] = collections.deque(maxlen=LATENCY_SAMPLES)
+
+            latency_history[key].append(seconds)
+
+    def get_latencies(self, host):
+        key = "shuffle_http_latency_%s" % host
+        if self.redis:
+            try:
+                return [float(value) for value in self.redis.lrange(key, 0, -1)]
+            except Exception as e:
+                self.logger.info("Failed getting latency from redis: %s" % e)
+
+        with latency_history_lock:
+            return list(latency_history.get(key, []))
+
+    def latency_percentile(self, host, percentile):
+        # None until enough requests to the host have been seen
+        latencies = sorted(self.get_latencies(host))
+        if len(latencies) < max(1, LATENCY_MIN_SAMPLES):
+            return None
+
+        index = int(-(-percentile * len(latencies) // 100)) - 1
+        return latencies[min(len(latencies)-1, max(0, index))]
+
+    def parse_timeout(self, timeout, default=5):
+        # Seconds, or adaptive to learn it from recent latencies to the host
+        if str(timeout).lower().strip() == "adaptive":
+            return "adaptive"
+
+        if not timeout:
+            return default
+
+        return int(timeout)
+
+    def adaptive_timeout(self, host):
+        def bounded(seconds):
+            return round(min(ADAPTIVE_TIMEOUT_MAX, max(ADAPTIVE_TIMEOUT_MIN, seconds * ADAPTIVE_TIMEOUT_FACTOR)), 3)
+
+        p99 = self.latency_percentile(host, 99)
+        if p99 == None:
+            return {"connect": ADAPTIVE_TIMEOUT_COLD, "read": ADAPTIVE_TIMEOUT_COLD, "adaptive": True, "learned": False}
+
+        # Connecting never needs long, and failed connects would otherwise grow it
+        connect = min(ADAPTIVE_TIMEOUT_COLD, bounded(self.latency_percentile(host, 50)))
+        return {"connect": connect, "read": bounded(p99), "adaptive": True, "learned": True}
+
+    def hedge_percentile(self, hedge):
+        # Accepts true, or a percentile such as 95 or p99
+        hedge = str(hedge).lower().strip()
+        if hedge in ["", "false", "none", "0"]:
+            return None
+
+        if hedge == "true":
+            return HEDGE_PERCENTILE
+
+        try:
+            percentile = float(hedge.lstrip("p"))
+        except ValueError:
+            return None
+
+        return percentile if 0 < percentile < 100 else None
+
+    def hedged_request(self, session, method, url, delay, timing=False, **kwargs):
+        """
+        Sends a second request if the first has no response after delay
+        seconds. The first response wins, and the other one is closed when it
+        arrives. Both are streamed, so the loser doesn't download the body.
+        """
+        stream = kwargs.pop("stream", False)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = [executor.submit(self.request_once, session, method, url, timing, stream=True, **kwargs)]
+            done, pending = concurrent.futures.wait(futures, timeout=delay)
+            if not done:
+                futures.append(executor.submit(self.request_once, session, method, url, timing, stream=True, **kwargs))
+                done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                # A failed request only loses if the other one can still succeed
+                winner = done.pop()
+                if winner.exception() != None and pending:
+                    done, pending = concurrent.futures.wait(pending)
+                    if done.pop().exception() == None:
+                        winner = [future for future in futures if future != winner][0]
+            else:
+                winner = futures[0]
+
+            for future in futures:
+                if future != winner:
+                    future.add_done_callback(lambda loser: loser.exception() or loser.result().close())
+        finally:
+            executor.shutdown(wait=False)
+
+        request = winner.result()
+        if not stream:
+            request.content
+            self.record_download(request)
+
+        self.set_metadata(request, "hedged", len(futures) > 1)
+        self.set_metadata(request, "hedge_delay_ms", round(delay*1000, 2))
+        return request
+
+    def request_once(self, session, method, url, timing=False, **kwargs):
+        if not timing:
+            return session.request(method, url, **kwargs)
+
+        # Always streams, to time the download separately from the headers
+        stream = kwargs.pop("stream", False)
+        connection_timings.record = {}
+        start = time.perf_counter()
+        try:
+            request = session.request(method, url, stream=True, **kwargs)
+        finally:
+            record = connection_timings.record
+            connection_timings.record = None
+
+        headers_at = time.perf_counter()
+        timings = {
+            "dns_ms": round(record.get("dns", 0)*1000, 2),
+            "connect_ms": round(record.get("connect", 0)*1000, 2),
+            "tls_ms": round(record.get("tls", 0)*1000, 2),
+            "ttfb_ms": round((headers_at - start - sum(record.values()))*1000, 2),
+            "connection_reused": "connect" not in record,
+        }
+
+        timings["total_ms"] = round((headers_at - start)*1000, 2)
+        self.set_metadata(request, "timing", timings)
+
+        # Streamed bodies are timed where they are read
+        request.timing_marks = (start, headers_at)
+        if not stream:
+            request.content
+            self.record_download(request)
+
+        return request
+
+    def record_download(self, request):
+        # Adds the download to the timing of a response read in full
+        marks = getattr(request, "timing_marks", None)
+        if marks == None:
+            return
+
+        start, headers_at = marks
+        now = time.perf_counter()
+        timings = request.shuffle_metadata["timing"]
+        timings["download_ms"] = round((now - headers_at)*1000, 2)
+        timings["bytes"] = request.raw.tell() if hasattr(request.raw, "tell") else len(request.content)
+        timings.pop("total_ms", None)
+        timings["total_ms"] = round((now - start)*1000, 2)
+
+    def send_request(self, method, url, retries=0, circuit_breaker=False, timing=False, hedge="", **kwargs):
+        session = self.get_session(url, kwargs.get("verify", True), kwargs.get("proxies"))
+
+        try:
+            retries = int(retries)
+        except (TypeError, ValueError):
+            retries = 0
+
+        circuit_breaker = str(circuit_breaker).lower() == "true"
+        timing = str(timing).lower() == "true"
+        host = urllib.parse.urlsplit(url).netloc.lower()
+
+        # Hedges after the chosen percentile of recent latencies to the host
+        hedge = self.hedge_percentile(hedge)
+        hedge_delay = self.latency_percentile(host, hedge) if hedge else None
+
+        adaptive = None
+        if kwargs.get("timeout") == "adaptive":
+            adaptive = self.adaptive_timeout(host)
+            kwargs["timeout"] = (adaptive["connect"], adaptive["read"])
+
+        attempt = 0
+        while True:
+            if circuit_breaker and self.breaker_open(host):
+                raise requests.exceptions.ConnectionError("Circuit breaker is open for %s after %d failures in a row. Retry in %d seconds" % (host, BREAKER_THRESHOLD, BREAKER_COOLDOWN))
+
+            start = time.perf_counter()
+            try:
+                if hedge_delay != None:
+                    request = self.hedged_request(session, method, url, hedge_delay, timing, **kwargs)
+                else:
+                    request = self.request_once(session, method, url, timing, **kwargs)
+
+                if hedge or adaptive:
+                    self.record_latency(host, request.elapsed.total_seconds())
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # A slow response counts as taking the whole timeout, so the timeout
+                # grows. Failed connects count as the time they took, so hosts which
+                # refuse connections get short timeouts and fail fast.
+                if adaptive and isinstance(e, requests.exceptions.ReadTimeout):
+                    self.record_latency(host, adaptive["read"])
+                elif adaptive:
+                    self.record_latency(host, time.perf_counter() - start)
+
+                if circuit_breaker:
+                    self.breaker_result(host, False)
+
+                if attempt >= retries:
+                    raise
+
+                delay = self.retry_delay(attempt)
+                self.logger.info("Retrying %s %s in %.2f seconds after error: %s" % (method, url, delay, e))
+            else:
+                if circuit_breaker:
+                    self.breaker_result(host, request.status_code < 500)
+
+                if request.status_code not in RETRY_STATUSES or attempt >= retries:
+                    if retries > 0:
+                        self.set_metadata(request, "attempts", attempt+1)
+                    if adaptive:
+                        self.set_metadata(request, "timeout", adaptive)
+
+                    return request
+
+                delay = self.retry_delay(attempt, request.headers.get("Retry-After"))
+                self.logger.info("Retrying %s %s in %.2f seconds after status %d" % (method, url, delay, request.status_code))
+                request.close()
+
+            attempt += 1
+            time.sleep(delay)
+
+    def response_to_entry(self, request):
+        return {
+            "status": request.status_code,
+            "url": request.url,
+            "headers": dict(request.headers.items()),
+            "body": base64.b64encode(request.content).decode(),
+            "stored_at": time.time(),
+        }
+
+    def entry_to_response(self, entry):
+        request = requests.models.Response()
+        request.status_code = entry["status"]
+        request.url = entry["url"]
+        request.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        request._content = base64.b64decode(entry["body"])
+        request._content_consumed = True
+        request.encoding = requests.utils.get_encoding_from_headers(request.headers)
+        return request
+
+    def request_key(self, prefix, url, headers, auth, extra=""):
+        authdata = [auth.username, auth.password] if auth else []
+        keydata = json.dumps([url, sorted(headers.items()), authdata] + ([extra] if extra else []))
+        return "%s_%s" % (prefix, hashlib.sha256(keydata.encode()).hexdigest())
+
+    def cache_max_age(self, headers):
+        # None means the response shouldn't be stored at all
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control:
+            return None
+
+        if "no-cache" in cache_control:
+            return 0
+
+        for directive in cache_control.split(","):
+            directive = directive.strip()
+            if directive.startswith("max-age="):
+                try:
+                    return int(directive.split("=", 1)[1].strip('"'))
+                except ValueError:
+                    return 0
+
+        return 0
+
+    def get_cache_entry(self, key, ttl=CACHE_TTL):
+        if self.redis:
+            try:
+                entry = self.redis.get(key)
+                if entry:
+                    return json.loads(entry)
+
+                return None
+            except Exception as e:
+                self.logger.info("Failed getting cache from redis: %s" % e)
+
+        with response_cache_lock:
+            entry = response_cache.get(key)
+            if entry and time.time() - entry["stored_at"] > ttl:
+                del response_cache[key]
+                return None
+
+            if entry:
+                response_cache.move_to_end(key)
+
+            return entry
+
+    def set_cache_entry(self, key, entry, ttl=CACHE_TTL):
+        if self.redis:
+            try:
+                self.redis.set(key, json.dumps(entry), ex=ttl)
+                return
+            except Exception as e:
+                self.logger.info("Failed setting cache in redis: %s" % e)
+
+        with response_cache_lock:
+            response_cache[key] = entry
+            response_cache.move_to_end(key)
+            while len(response_cache) > CACHE_SIZE:
+                response_cache.popitem(last=False)
+
+    def send_cached_request(self, method, url, headers, auth, max_response_bytes=0, **kwargs):
+        key = self.request_key("shuffle_http_cache", url, headers, auth)
+        entry = self.get_cache_entry(key)
+        if entry and time.time() - entry["stored_at"] < entry["max_age"]:
+            request = self.entry_to_response(entry)
+            self.set_metadata(request, "cache", "hit")
+            return request
+
+        # Ask the server whether our copy is still valid
+        headers = dict(headers)
+        if entry:
+            cachedheaders = requests.structures.CaseInsensitiveDict(entry["headers"])
+            if "ETag" in cachedheaders and "If-None-Match" not in headers:
+                headers["If-None-Match"] = cachedheaders["ETag"]
+            if "Last-Modified" in cachedheaders and "If-Modified-Since" not in headers:
+                headers["If-Modified-Since"] = cachedheaders["Last-Modified"]
+
+        request = self.send_request(method, url, headers=headers, auth=auth, stream=True, **kwargs)
+        if entry and request.status_code == 304:
+            request.close()
+            max_age = self.cache_max_age(request.headers)
+            for header, value in request.headers.items():
+                if header.lower() not in ["content-length", "content-encoding", "transfer-encoding"]:
+                    entry["headers"][header] = value
+
+            entry["stored_at"] = time.time()
+            if max_age != None:
+                entry["max_age"] = max_age
+                self.set_cache_entry(key, entry)
+
+            request = self.entry_to_response(entry)
+            self.set_metadata(request, "cache", "revalidated")
+            return request
+
+        max_age = self.cache_max_age(request.headers)
+        shareable = self.read_shareable(request, max_response_bytes)
+        if request.status_code == 200 and max_age != None and shareable:
+            entry = self.response_to_entry(request)
+            entry["max_age"] = max_age
+            self.set_cache_entry(key, entry)
+
+        self.set_metadata(request, "cache", "miss")
+        return request
+
+    def send_coalesced_request(self, url, headers, auth, window, timeout, send):
+        key = self.request_key("shuffle_http_flight", url, headers, auth)
+        if self.redis:
+            try:
+                entry = self.redis.get(key)
+            except Exception as e:
+                self.logger.info("Failed getting shared request from redis: %s" % e)
+            else:
+                return self.send_coalesced_redis(key, entry, window, timeout, send)
+
+        return self.send_coalesced_local(key, window, timeout, send)
+
+    def send_coalesced_redis(self, key, entry, window, timeout, send):
+        deadline = time.time() + timeout + window
+        while not entry:
+            if self.redis.set("%s_lock" % key, "1", nx=True, px=max(1, int((timeout + window) * 1000))):
+                break
+
+            # Gives up on waiting if the request never finished
+            if time.time() > deadline:
+                request = send()
+                self.set_metadata(request, "coalesced", False)
+                return request
+
+            time.sleep(0.05)
+            entry = self.redis.get(key)
+
+        if entry:
+            entry = json.loads(entry)
+
+            # The leader had nothing to share, so everyone sends on their own
+            if entry.get("shared") == False:
+                request = send()
+                self.set_metadata(request, "coalesced", False)
+                return request
+
+            request = self.entry_to_response(entry)
+            self.set_metadata(request, "coalesced", True)
+            return request
+
+        shared = False
+        try:
+            request = send()
+
+            # Windows under a millisecond still need a positive expiry
+            if self.is_shareable(request):
+                self.redis.set(key, json.dumps(self.response_to_entry(request)), px=max(1, int(window * 1000)))
+                shared = True
+        finally:
+            # Published before the lock is released, and kept long enough for
+            # every waiter's next poll, so they send at once instead of taking
+            # the lock one after another
+            if not shared:
+                self.redis.set(key, json.dumps({"shared": False}), px=max(500, int(window * 1000)))
+
+            self.redis.delete("%s_lock" % key)
+
+        self.set_metadata(request, "coalesced", False)
+        return request
+
+    def is_shareable(self, request):
+        # Bodies left to stream, or read but over CACHE_MAX_BODY, aren't shared
+        return request._content_consumed and len(request.content) <= CACHE_MAX_BODY
+
+    def send_coalesced_local(self, key, window, timeout, send):
+        with inflight_lock:
+            now = time.time()
+            for oldkey in list(inflight_requests.keys()):
+                if inflight_requests[oldkey]["event"].is_set() and inflight_requests[oldkey]["expires"] < now:
+                    del inflight_requests[oldkey]
+
+            flight = inflight_requests.get(key)
+            leader = flight == None
+            if leader:
+                flight = {"event": threading.Event(), "entry": None, "expires": 0}
+                inflight_requests[key] = flight
+
+        if not leader:
+            if flight["event"].wait(timeout + window) and flight["entry"]:
+                request = self.entry_to_response(flight["entry"])
+                self.set_metadata(request, "coalesced", True)
+                return request
+
+            request = send()
+            self.set_metadata(request, "coalesced", False)
+            return request
+
+        try:
+            request = send()
+
+            if self.is_shareable(request):
+                flight["entry"] = self.response_to_entry(request)
+        finally:
+            flight["expires"] = time.time() + window
+            flight["event"].set()
+
+            # Failed requests aren't shared with anyone arriving later
+            if flight["entry"] == None:
+                with inflight_lock:
+                    inflight_requests.pop(key, None)
+
+        self.set_metadata(request, "coalesced", False)
+        return request
+
+    def parse_size(self, value, default=0):
+        # Sizes in bytes, or with a KB, MB or GB suffix
+        if value == None or str(value).strip() == "":
+            return default
+
+        match = re.match(r"^\s*(\d+)\s*([kmg]?)b?\s*$", str(value).lower())
+        if not match:
+            return default
+
+        return int(match.group(1)) * {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}[match.group(2)]
+
+    def check_response_size(self, request, max_response_bytes):
+        # Aborts before reading anything when the announced size is over the cap
+        size = request.headers.get("Content-Length", "").strip()
+        if max_response_bytes and size.isdigit() and int(size) > max_response_bytes:
+            request.close()
+            raise ResponseTooLarge("Response of %s bytes is larger than max_response_bytes (%d)" % (size, max_response_bytes))
+
+    def read_shareable(self, request, max_response_bytes=0):
+        """
+        Reads a streamed body so it can be cached or shared, enforcing
+        max_response_bytes. Bodies announced as larger than CACHE_MAX_BODY
+        are left to stream. Returns whether the body is small enough to share.
+        """
+        self.check_response_size(request, max_response_bytes)
+        size = request.headers.get("Content-Length", "").strip()
+        if size.isdigit() and int(size) > CACHE_MAX_BODY:
+            return False
+
+        self.read_limited(request, 0, max_response_bytes)
+        return len(request.content) <= CACHE_MAX_BODY
+
+    def send_capped(self, method, url, max_response_bytes=None, **kwargs):
+        # Sends and reads the whole body, aborting once it is over max_response_bytes
+        if max_response_bytes == None:
+            max_response_bytes = MAX_RESPONSE_BYTES
+
+        if not max_response_bytes:
+            return self.send_request(method, url, **kwargs)
+
+        request = self.send_request(method, url, stream=True, **kwargs)
+        self.read_limited(request, 0, max_response_bytes)
+        return request
+
+    def stream_to_file(self, request, max_response_bytes=0, spooled=None):
+        self.check_response_size(request, max_response_bytes)
+
+        if spooled == None:
+            spooled = SpooledFile()
+        try:
+            for chunk in request.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                spooled.write(chunk)
+                if max_response_bytes and spooled.size > max_response_bytes:
+                    spooled.close()
+                    raise ResponseTooLarge("Response is larger than max_response_bytes (%d)" % max_response_bytes)
+        finally:
+            request.close()
+
+        self.record_download(request)
+        return spooled
+
+    def read_limited(self, request, max_inline_bytes, max_response_bytes):
+        """
+        Reads the body into the response when it fits in max_inline_bytes.
+        Larger bodies are spooled to a file, which is returned instead.
+        """
+        self.check_response_size(request, max_response_bytes)
+
+        size = request.headers.get("Content-Length", "").strip()
+        if max_inline_bytes and size.isdigit() and int(size) > max_inline_bytes:
+            return self.stream_to_file(request, max_response_bytes)
+
+        chunks = []
+        received = 0
+        for chunk in request.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            chunks.append(chunk)
+            received += len(chunk)
+            if max_response_bytes and received > max_response_bytes:
+                request.close()
+                raise ResponseTooLarge("Response is larger than max_response_bytes (%d)" % max_response_bytes)
+
+            if max_inline_bytes and received > max_inline_bytes:
+                # Continues on disk with what has been read so far
+                spooled = SpooledFile()
+                for chunk in chunks:
+                    spooled.write(chunk)
+
+                return self.stream_to_file(request, max_response_bytes, spooled)
+
+        request._content = b"".join(chunks)
+        request._content_consumed = True
+        request.close()
+        self.record_download(request)
+        return None
+
+    def spilled_response(self, request, spooled, include_headers=True, include_cookies=True):
+        spooled.file.seek(0)
+        preview = spooled.file.read(PREVIEW_BYTES)
+
+        fileret = self.upload_spooled("response.txt", spooled)
+        if not fileret["success"]:
+            return json.dumps(fileret)
+
+        try:
+            preview = preview.decode(request.encoding or "utf-8", errors="replace")
+        except LookupError:
+            preview = preview.decode("utf-8", errors="replace")
+
+        parseddata = self.parse_response(request, parse_body=False, include_headers=include_headers, include_cookies=include_cookies)
+        del parseddata["body"]
+        parseddata.update(fileret)
+        parseddata["spilled"] = True
+        parseddata["preview"] = preview
+        return json.dumps(parseddata)
+
+    def raw_stream(self, request):
+        # The decoded body as a file, from the content if it was already read
+        if request._content_consumed:
+            return io.BytesIO(request.content)
+
+        # Keeps the stream open at the end, as io wrappers read past it
+        request.raw.decode_content = True
+        request.raw.auto_close = False
+        return request.raw
+
+    def declared_charset(self, request):
+        # Only a charset set by the server, not the text/* default of ISO-8859-1
+        charset = re.search(r"charset=[\"']?([^;\s\"']+)", request.headers.get("Content-Type", ""), re.IGNORECASE)
+        if charset:
+            try:
+                return codecs.lookup(charset.group(1)).name
+            except LookupError:
+                pass
+
+        return ""
+
+    def text_stream(self, request):
+        source = self.raw_stream(request)
+        encoding = self.declared_charset(request) or "utf-8-sig"
+        return io.TextIOWrapper(source, encoding=encoding, errors="replace", newline="")
+
+    def xml_name(self, tag):
+        return tag.split("}", 1)[1] if tag.startswith("{") else tag
+
+    def xml_to_dict(self, element):
+        # Attributes as @name, repeated children as lists and text as #text when there is more
+        data = {"@%s" % self.xml_name(key): value for key, value in element.attrib.items()}
+        for child in element:
+            name = self.xml_name(child.tag)
+            value = self.xml_to_dict(child)
+            if name not in data:
+                data[name] = value
+            elif isinstance(data[name], list):
+                data[name].append(value)
+            else:
+                data[name] = [data[name], value]
+
+        text = (element.text or "").strip()
+        if not data:
+            return text
+
+        if text:
+            data["#text"] = text
+
+        return data
+
+    def iter_xml(self, source, record_tag=""):
+        """
+        Yields each record element as a dict: elements named record_tag, or
+        the children of the root element. Records are removed from the tree
+        once read, so it never holds more than one.
+        """
+        stack = []
+        for event, element in xml.etree.ElementTree.iterparse(source, events=("start", "end")):
+            if event == "start":
+                stack.append(element)
+                continue
+
+            stack.pop()
+            if (record_tag and self.xml_name(element.tag) == record_tag) or (not record_tag and len(stack) == 1):
+                yield self.xml_to_dict(element)
+                if stack:
+                    stack[-1].remove(element)
+
+    def iter_records(self, request, parse_as, record_tag=""):
+        if parse_as == "csv":
+            for row in csv.DictReader(self.text_stream(request)):
+                yield row
+        elif parse_as == "ndjson":
+            for number, line in enumerate(self.text_stream(request)):
+                if not line.strip():
+                    continue
+
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    raise ValueError("Line %d is not valid JSON: %s" % (number+1, e))
+        elif parse_as == "xml":
+            for record in self.iter_xml(self.raw_stream(request), record_tag):
+                yield record
+
+    def parse_records(self, request, parse_as, to_file=False, select="", max_records=0, record_tag="", include_headers=True, include_cookies=True):
+        """
+        Parses a CSV, NDJSON or XML body one record at a time from the
+        stream, into a list in the body or into an NDJSON file.
+        """
+        records = []
+        spooled = SpooledFile() if to_file else None
+        count = 0
+        truncated = False
+        error = ""
+        try:
+            for record in self.iter_records(request, parse_as, record_tag):
+                if max_records and count >= max_records:
+                    truncated = True
+                    break
+
+                if select:
+                    record = self.select_fields(record, select)
+
+                if to_file:
+                    spooled.write((json.dumps(record) + "\n").encode())
+                else:
+                    records.append(record)
+
+                count += 1
+        except (ValueError, csv.Error, xml.etree.ElementTree.ParseError, requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            error = "Failed parsing the body as %s after %d records: %s" % (parse_as, count, e)
+        finally:
+            request.close()
+
+        self.record_download(request)
+        parseddata = self.parse_response(request, parse_body=False, include_headers=include_headers, include_cookies=include_cookies)
+        parseddata["success"] = not error
+        parseddata["records"] = count
+        parseddata["truncated"] = truncated
+        if error:
+            parseddata["error"] = error
+
+        if not to_file:
+            parseddata["body"] = records
+            return json.dumps(parseddata)
+
+        del parseddata["body"]
+        fileret = self.upload_spooled("records.ndjson", spooled)
+        parseddata.update(fileret)
+        parseddata["success"] = fileret["success"] and not error
+        return json.dumps(parseddata)
+
+    def respond(self, request, to_file=False, raw_json=False, select="", include_headers=True, include_cookies=True, max_inline_bytes=0, max_response_bytes=0, decoding="", parse_as="", record_tag="", max_records=0, diff_key=""):
+        try:
+            # Record formats are parsed from the stream instead of being read whole
+            if parse_as:
+                self.check_response_size(request, max_response_bytes)
+                return self.parse_records(request, parse_as, to_file, select, max_records, record_tag, include_headers, include_cookies)
+
+            if to_file:
+                return self.return_file(request, max_response_bytes)
+
+            # Bodies over max_inline_bytes go to a file instead of the result
+            if max_inline_bytes or max_response_bytes:
+                spooled = self.read_limited(request, max_inline_bytes, max_response_bytes)
+                if spooled:
+                    return self.spilled_response(request, spooled, include_headers, include_cookies)
+        except ResponseTooLarge as e:
+            return json.dumps({"success": False, "status": request.status_code, "url": request.url, "error": str(e)})
+
+        if diff_key:
+            return self.diff_response(request, diff_key, select, include_headers, include_cookies, decoding)
+
+        return self.prepare_response(request, raw_json, select, include_headers, include_cookies, decoding)
+
+    def range_parts(self, request, download_parts):
+        # How many parts to download in, or 0 if the server can't serve ranges
+        try:
+            download_parts = min(int(download_parts), RANGE_MAX_PARTS)
+        except (TypeError, ValueError):
+            return 0
+
+        size = request.headers.get("Content-Length", "").strip()
+        if download_parts < 2 or request.status_code != 200 or not size.isdigit():
+            return 0
+
+        if request.headers.get("Accept-Ranges", "").lower() != "bytes" or request.headers.get("Content-Encoding"):
+            return 0
+
+        download_parts = min(download_parts, int(size) // max(1, RANGE_MIN_PART_SIZE))
+        return download_parts if download_parts >= 2 else 0
+
+    def fetch_range(self, fileobj, url, start, end, validator, request=None, **kwargs):
+        """
+        Writes bytes start-end of the file at their offset in fileobj. An
+        interrupted range is requested again from where it stopped.
+        """
+        position = start
+        for attempt in range(RANGE_ATTEMPTS):
+            try:
+                if request == None:
+                    headers = dict(kwargs.pop("headers", {}))
+                    headers["Range"] = "bytes=%d-%d" % (position, end)
+                    if validator:
+                        headers["If-Range"] = validator
+
+                    kwargs["headers"] = headers
+                    request = self.send_request("GET", url, stream=True, **kwargs)
+
+                    # A 200 means the range was ignored, or the file changed since the first part
+                    content_range = request.headers.get("Content-Range", "")
+                    if request.status_code != 206 or not content_range.startswith("bytes %d-%d/" % (position, end)):
+                        raise RangeNotSupported("Got status %d with Content-Range '%s' for range %d-%d" % (request.status_code, content_range, position, end))
+
+                for chunk in request.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - position]
+                    os.pwrite(fileobj.fileno(), chunk, position)
+                    position += len(chunk)
+                    if position > end:
+                        return
+
+                self.logger.info("Range %d-%d of %s ended at %d" % (start, end, url, position))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                self.logger.info("Range %d-%d of %s failed at %d: %s" % (start, end, url, position, e))
+            finally:
+                if request != None:
+                    request.close()
+                    request = None
+
+        raise requests.exceptions.ConnectionError("Failed to download range %d-%d of %s after %d attempts" % (start, end, url, RANGE_ATTEMPTS))
+
+    def expected_digests(self, headers):
+        # Digests the server sent for the whole file, as {algorithm: hex digest}
+        digests = {}
+        for header in ["Repr-Digest", "Digest"]:
+            for item in headers.get(header, "").split(","):
+                if "=" not in item:
+                    continue
+
+                algorithm, value = item.split("=", 1)
+                algorithm = algorithm.strip().lower().replace("-", "")
+                if algorithm in ["sha256", "md5"]:
+                    try:
+                        digests[algorithm] = base64.b64decode(value.strip().strip(":")).hex()
+                    except ValueError:
+                        pass
+
+        if headers.get("Content-MD5"):
+            try:
+                digests["md5"] = base64.b64decode(headers["Content-MD5"].strip()).hex()
+            except ValueError:
+                pass
+
+        return digests
+
+    def download_ranges(self, request, parts, **kwargs):
+        """
+        Downloads the file in parallel byte ranges written into one temporary
+        file, and uploads it to Shuffle. The first range is read from the
+        response which is already open.
+        """
+        url = request.url
+        size = int(request.headers["Content-Length"])
+        part_size = -(-size // parts)
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        validator = request.headers.get("ETag") or request.headers.get("Last-Modified")
+        digests = self.expected_digests(request.headers)
+
+        fileobj = tempfile.TemporaryFile()
+        try:
+            fileobj.truncate(size)
+
+            def fetch(index):
+                start, end = ranges[index]
+                first = request if index == 0 else None
+                return self.fetch_range(fileobj, url, start, end, validator, first, **dict(kwargs))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                list(executor.map(fetch, range(len(ranges))))
+
+            # Reads the assembled file once to check it end to end
+            hashers = {"sha256": hashlib.sha256(), "md5": hashlib.md5()}
+            fileobj.seek(0)
+            for chunk in iter(lambda: fileobj.read(STREAM_CHUNK_SIZE), b""):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+
+            for algorithm, expected in digests.items():
+                if hashers[algorithm].hexdigest() != expected:
+                    return {"success": False, "error": "Checksum mismatch for %s: expected %s %s, got %s" % (url, algorithm, expected, hashers[algorithm].hexdigest())}
+
+            fileobj.seek(0)
+            file_id = self.upload_file("response.txt", fileobj, size)
+        finally:
+            request.close()
+            fileobj.close()
+
+        if not file_id:
+            return {"success": False, "error": "Failed to upload response.txt as a file"}
+
+        return {
+            "success": True,
+            "file_id": file_id,
+            "size": size,
+            "sha256": hashers["sha256"].hexdigest(),
+            "parts": len(ranges),
+            "checksum_verified": len(digests) > 0,
+        }
+
+    def get_full_execution(self):
+        full_execution = self.full_execution
+        if isinstance(full_execution, str):
+            full_execution = json.loads(full_execution)
+
+        return full_execution
+
+    def open_file(self, file_id):
+        # Same as get_file in the SDK, but streams the content instead of loading it
+        full_execution = self.get_full_execution()
+        proxies = getattr(self, "proxy_config", None)
+        headers = {
+            "Authorization": "Bearer %s" % self.authorization,
+            "User-Agent": "Shuffle 1.1.0",
+        }
+
+        get_path = "/api/v1/files/%s?execution_id=%s" % (file_id, full_execution["execution_id"])
+        ret = requests.get("%s%s" % (self.url, get_path), headers=headers, verify=False, proxies=proxies)
+        if ret.status_code != 200:
+            self.logger.info("Bad status code when getting file %s: %d" % (file_id, ret.status_code))
+            return "", None
+
+        content_path = "/api/v1/files/%s/content?execution_id=%s" % (file_id, full_execution["execution_id"])
+        content = requests.get("%s%s" % (self.url, content_path), headers=headers, verify=False, proxies=proxies, stream=True)
+        if content.status_code != 200:
+            self.logger.info("Bad status code when getting content of file %s: %d" % (file_id, content.status_code))
+            content.close()
+            return "", None
+
+        return ret.json().get("filename", "file"), content
+
+    def file_body(self, file_id, multipart_field=""):
+        # Returns a body streaming the file, and its content type
+        filename, content = self.open_file(file_id)
+        if not content:
+            return None, ""
+
+        if not multipart_field:
+            return content.iter_content(chunk_size=STREAM_CHUNK_SIZE), "application/octet-stream"
+
+        # Multipart needs the size up front, so files without one are spooled first
+        size = content.headers.get("Content-Length")
+        if size and not content.headers.get("Content-Encoding"):
+            content.raw.decode_content = True
+            body = MultipartFile(multipart_field, filename, content.raw, int(size))
+        else:
+            spooled = self.stream_to_file(content)
+            spooled.file.seek(0)
+            body = MultipartFile(multipart_field, filename, spooled.file, spooled.size)
+
+        return body, body.content_type
+
+    def upload_file(self, filename, fileobj, size):
+        # Same as set_files in the SDK, but streams the upload from fileobj
+        full_execution = self.get_full_execution()
+        proxies = getattr(self, "proxy_config", None)
+        headers = {
+            "Authorization": "Bearer %s" % self.authorization,
+            "User-Agent": "Shuffle 1.1.0",
+        }
+
+        create_path = "/api/v1/files/create?execution_id=%s" % full_execution["execution_id"]
+        data = {
+            "filename": filename,
+            "workflow_id": full_execution["workflow"]["id"],
+            "org_id": full_execution["workflow"]["execution_org"]["id"],
+        }
+
+        ret = requests.post("%s%s" % (self.url, create_path), headers=headers, json=data, verify=False, proxies=proxies)
+        if ret.status_code != 200 or not ret.json().get("success"):
+            self.logger.info("Bad status code in file creation: %d" % ret.status_code)
+            return ""
+
+        file_id = ret.json()["id"]
+        body = MultipartFile("shuffle_file", filename, fileobj, size)
+        headers["Content-Type"] = body.content_type
+
+        upload_path = "/api/v1/files/%s/upload?execution_id=%s" % (file_id, full_execution["execution_id"])
+        ret = requests.post("%s%s" % (self.url, upload_path), headers=headers, data=body, verify=False, proxies=proxies)
+        if ret.status_code != 200:
+            self.logger.info("Bad status code in file upload: %d" % ret.status_code)
+            return ""
+
+        return file_id
+
+    def upload_spooled(self, filename, spooled):
+        try:
+            spooled.file.seek(0)
+            file_id = self.upload_file(filename, spooled.file, spooled.size)
+        finally:
+            spooled.close()
+
+        if not file_id:
+            return {"success": False, "error": "Failed to upload %s as a file" % filename}
+
+        return {"success": True, "file_id": file_id, "size": spooled.size, "sha256": spooled.sha256()}
+
+    def return_file(self, requestdata, max_response_bytes=0):
+        # Streamed responses are written in chunks, and kept as raw bytes
+        if isinstance(requestdata, requests.models.Response):
+            return self.upload_spooled("response.txt", self.stream_to_file(requestdata, max_response_bytes))
+
         filedata = {
             "filename": "response.txt",
             "data": requestdata,
@@ -136,39 +1731,294 @@ class HTTP(AppBase):
 
         return fileret
             
-    def prepare_response(self, request):
-        try:
+    def is_json_response(self, request):
+        mimetype = request.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        return mimetype == "application/json" or mimetype.endswith("+json")
+
+    def decode_body(self, request, decoding=""):
+        """
+        Decodes the body with the charset declared in Content-Type, or else by
+        the decoding strategy. The ISO-8859-1 default of text/* types doesn't
+        count as declared. declared and utf-8 use UTF-8 (with a BOM skipped
+        on JSON for declared), sample detects the charset on the start of
+        bodies which aren't UTF-8 and detect runs charset detection on the
+        whole body.
+        """
+        decoding = str(decoding or DECODING).lower().strip()
+        charset = self.declared_charset(request)
+        if charset:
+            return request.content.decode(charset, errors="replace")
+
+        if decoding in ["utf-8", "utf8"]:
+            return request.content.decode("utf-8", errors="replace")
+
+        if self.is_json_response(request):
+            return request.content.decode("utf-8-sig", errors="replace")
+
+        if decoding == "detect":
+            try:
+                return request.content.decode(request.apparent_encoding or "utf-8", errors="replace")
+            except LookupError:
+                pass
+
+        if decoding == "sample":
+            try:
+                return request.content.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+
+            chardet = getattr(requests.compat, "chardet", None)
+            if chardet != None:
+                encoding = chardet.detect(request.content[:DECODING_SAMPLE_SIZE]).get("encoding")
+                if encoding:
+                    try:
+                        return request.content.decode(encoding, errors="replace")
+                    except LookupError:
+                        pass
+
+        return request.content.decode("utf-8", errors="replace")
+
+    def parse_response(self, request, parse_body=True, select="", include_headers=True, include_cookies=True, decoding=""):
+        jsondata = ""
+        if parse_body:
+            jsondata = self.decode_body(request, decoding)
+
+            # Skips parsing HTML, binary etc. unless it looks like JSON
+            if self.is_json_response(request) or re.match(r"\s*[\[{]", jsondata):
+                try:
+                    jsondata = json.loads(jsondata)
+                except:
+                    pass
+
+            if select and not isinstance(jsondata, str):
+                jsondata = self.select_fields(jsondata, select)
+
+        parseddata = {
+            "status": request.status_code,
+            "body": jsondata,
+            "url": request.url,
+        }
+
+        if str(include_headers).lower() != "false":
             parsedheaders = {}
             for key, value in request.headers.items():
                 parsedheaders[key] = value
 
+            parseddata["headers"] = parsedheaders
+
+        if str(include_cookies).lower() != "false":
             cookies = {}
             if request.cookies:
                 for key, value in request.cookies.items():
                     cookies[key] = value
 
-            
-            jsondata = request.text
-            try:
-                jsondata = json.loads(jsondata)
-            except:
-                pass
+            parseddata["cookies"] = cookies
 
-            parseddata = {
-                "status": request.status_code,
-                "body": jsondata,
-                "url": request.url,
-                "headers": parsedheaders,
-                "cookies":cookies,
-                "success": True,
-            }
+        parseddata["success"] = True
 
+        # Extra information from the request, such as cache status
+        parseddata.update(getattr(request, "shuffle_metadata", {}))
+        return parseddata
+
+    def prepare_response(self, request, raw_json=False, select="", include_headers=True, include_cookies=True, decoding=""):
+        try:
+            # Embeds the JSON body as is, instead of dumping it again. It is still
+            # validated, as a malformed body would break the whole output.
+            if str(raw_json).lower() == "true" and not select and self.is_json_response(request):
+                body = self.decode_body(request, decoding).strip()
+                try:
+                    json.loads(body)
+                except ValueError:
+                    body = ""
+
+                if body:
+                    placeholder = "shuffle_raw_body_%s" % uuid.uuid4().hex
+                    parseddata = self.parse_response(request, parse_body=False, include_headers=include_headers, include_cookies=include_cookies)
+                    parseddata["body"] = placeholder
+                    return json.dumps(parseddata).replace('"%s"' % placeholder, body, 1)
+
+            parseddata = self.parse_response(request, select=select, include_headers=include_headers, include_cookies=include_cookies, decoding=decoding)
             return json.dumps(parseddata)
         except Exception as e:
             print(f"[WARNING] Failed in request: {e}")
-            return request.text
+            return self.decode_body(request, decoding)
+
+    def normalize_url(self, url):
+        # Same resource regardless of host casing, default port or query order
+        parsedurl = urllib.parse.urlsplit(url)
+        scheme = parsedurl.scheme.lower()
+        netloc = parsedurl.netloc.lower()
+        if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+            netloc = netloc.rsplit(":", 1)[0]
+
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parsedurl.query, keep_blank_values=True)))
+        return urllib.parse.urlunsplit((scheme, netloc, parsedurl.path or "/", query, ""))
+
+    def json_diff(self, old, new, path="", changes=None):
+        # Changes as JSON pointer paths, stopping after DIFF_MAX_CHANGES
+        if changes is None:
+            changes = []
+
+        if len(changes) > DIFF_MAX_CHANGES:
+            return changes
+
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in old:
+                if key not in new:
+                    changes.append({"op": "remove", "path": self.pointer(path, key), "old": old[key]})
+
+            for key in new:
+                if key not in old:
+                    changes.append({"op": "add", "path": self.pointer(path, key), "value": new[key]})
+                else:
+                    self.json_diff(old[key], new[key], self.pointer(path, key), changes)
+        elif isinstance(old, list) and isinstance(new, list):
+            for index in range(max(len(old), len(new))):
+                if index >= len(new):
+                    changes.append({"op": "remove", "path": self.pointer(path, index), "old": old[index]})
+                elif index >= len(old):
+                    changes.append({"op": "add", "path": self.pointer(path, index), "value": new[index]})
+                else:
+                    self.json_diff(old[index], new[index], self.pointer(path, index), changes)
+        elif type(old) != type(new) or old != new:
+            changes.append({"op": "replace", "path": path, "old": old, "value": new})
+
+        return changes
+
+    def pointer(self, path, key):
+        return "%s/%s" % (path, str(key).replace("~", "~0").replace("/", "~1"))
 
-    def GET(self, url, headers="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+    def diff_response(self, request, key, select="", include_headers=True, include_cookies=True, decoding=""):
+        parseddata = self.parse_response(request, select=select, include_headers=include_headers, include_cookies=include_cookies, decoding=decoding)
+
+        # Failed requests are returned as is, without replacing the last body
+        if request.status_code >= 300:
+            return json.dumps(parseddata)
+
+        body = parseddata["body"]
+        if isinstance(body, str):
+            content = body
+        else:
+            content = json.dumps(body, sort_keys=True)
+
+        digest = hashlib.sha256(content.encode("utf-8", "surrogateescape")).hexdigest()
+        last = self.get_cache_entry(key, DIFF_TTL)
+
+        entry = {"sha256": digest, "stored_at": time.time()}
+        if not isinstance(body, str) and len(content) <= CACHE_MAX_BODY:
+            entry["snapshot"] = body
+
+        # Also refreshes the TTL when nothing changed
+        self.set_cache_entry(key, entry, DIFF_TTL)
+
+        if last and last.get("sha256") == digest:
+            unchanged = {
+                "success": True,
+                "status": request.status_code,
+                "url": request.url,
+                "changed": False,
+                "sha256": digest,
+            }
+            unchanged.update(getattr(request, "shuffle_metadata", {}))
+            return json.dumps(unchanged)
+
+        parseddata["changed"] = True
+        parseddata["sha256"] = digest
+        parseddata["previous_sha256"] = last.get("sha256", "") if last else ""
+
+        # The diff replaces the body when both versions have a JSON snapshot
+        if last and "snapshot" in last and "snapshot" in entry:
+            changes = self.json_diff(last["snapshot"], body)
+            parseddata["diff"] = changes[:DIFF_MAX_CHANGES]
+            if len(changes) > DIFF_MAX_CHANGES:
+                parseddata["diff_truncated"] = True
+            else:
+                del parseddata["body"]
+
+        return json.dumps(parseddata)
+
+    def loadparam(self, value):
+        if not isinstance(value, str):
+            return value
+
+        try:
+            return json.loads(value)
+        except json.decoder.JSONDecodeError:
+            return ast.literal_eval(value)
+
+    def run_concurrently(self, func, items, concurrency=10):
+        try:
+            concurrency = int(concurrency)
+        except (TypeError, ValueError):
+            concurrency = 10
+
+        if concurrency < 1:
+            concurrency = 1
+
+        if len(items) == 0:
+            return []
+
+        # Results are returned in the same order as the input items
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def get_json_path(self, data, path):
+        # Supports simple paths such as $.data.items, data.items[0] and data.items.0,
+        # and wildcards such as $.data[*].id
+        path = path.strip()
+        if path.startswith("$"):
+            path = path[1:]
+
+        keys = [key.strip("'\"") for key in re.findall(r"[^.\[\]]+", path)]
+        return self.walk_json_path(data, keys)
+
+    def walk_json_path(self, data, keys):
+        for index, key in enumerate(keys):
+            if key == "*":
+                if isinstance(data, dict):
+                    data = list(data.values())
+                elif not isinstance(data, list):
+                    return None
+
+                values = [self.walk_json_path(item, keys[index+1:]) for item in data]
+                return [value for value in values if value != None]
+
+            if isinstance(data, list):
+                try:
+                    data = data[int(key)]
+                except (ValueError, IndexError):
+                    return None
+            elif isinstance(data, dict):
+                if key not in data:
+                    return None
+
+                data = data[key]
+            else:
+                return None
+
+        return data
+
+    def select_fields(self, data, select):
+        fields = [field.strip() for field in str(select).split(",") if field.strip()]
+        if not fields:
+            return data
+
+        # Lists of objects are projected item by item, unless the path starts at the list
+        if isinstance(data, list) and not any(re.match(r"^[$\[\d*]", field) for field in fields):
+            return [self.select_fields(item, select) for item in data]
+
+        if len(fields) == 1:
+            return self.get_json_path(data, fields[0])
+
+        return {field: self.get_json_path(data, field) for field in fields}
+
+    def set_query_param(self, url, key, value):
+        parsedurl = urllib.parse.urlsplit(url)
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(parsedurl.query, keep_blank_values=True) if k != key]
+        query.append((key, str(value)))
+        return urllib.parse.urlunsplit(parsedurl._replace(query=urllib.parse.urlencode(query)))
+
+    def GET(self, url, headers="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, cache=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, coalesce_window=0, max_inline_bytes="", max_response_bytes="", download_parts=0, hedge="", decoding="", parse_as="", record_tag="", max_records=0, diff_against_last=False):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
@@ -190,29 +2040,91 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.get(url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout)
-        if not to_file:
-            return self.prepare_response(request)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
+
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
+
+        cache = str(cache).lower() == "true"
+
+        # Bodies compared with the last one seen for the same request
+        diff_key = ""
+        if str(diff_against_last).lower() == "true" and not to_file and not parse_as:
+            diff_key = self.request_key("shuffle_http_diff", self.normalize_url(url), parsed_headers, auth, select)
+
+        try:
+            coalesce_window = float(coalesce_window) if coalesce_window else 0
+        except ValueError:
+            coalesce_window = 0
+
+        # Streamed file downloads are never cached or shared
+        if not to_file and (cache or coalesce_window > 0):
+            # Streamed, so the size limits apply before anything is stored or shared
+            def send():
+                if cache:
+                    return self.send_cached_request("GET", url, parsed_headers, auth, max_response_bytes, verify=verify, proxies=proxies, timeout=timeout, retries=retries, circuit_breaker=circuit_breaker, timing=timing, hedge=hedge)
+
+                request = self.send_request("GET", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=True, retries=retries, circuit_breaker=circuit_breaker, timing=timing, hedge=hedge)
+                self.read_shareable(request, max_response_bytes)
+                return request
+
+            try:
+                if coalesce_window > 0:
+                    request = self.send_coalesced_request(url, parsed_headers, auth, coalesce_window, ADAPTIVE_TIMEOUT_MAX if timeout == "adaptive" else timeout, send)
+                else:
+                    request = send()
+            except ResponseTooLarge as e:
+                return json.dumps({"success": False, "url": url, "error": str(e)})
 
-        return self.return_file(request.text)
+            return self.respond(request, False, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records, diff_key)
 
-    def POST(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+        request = self.send_request("GET", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing, hedge=hedge)
+
+        # Large files are downloaded in parallel ranges when the server supports it
+        parts = self.range_parts(request, download_parts) if to_file and not parse_as else 0
+        if parts:
+            try:
+                self.check_response_size(request, max_response_bytes)
+                return self.download_ranges(request, parts, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, retries=retries, circuit_breaker=circuit_breaker)
+            except ResponseTooLarge as e:
+                return json.dumps({"success": False, "status": request.status_code, "url": request.url, "error": str(e)})
+            except RangeNotSupported as e:
+                self.logger.info("Falling back to a single stream: %s" % e)
+                request = self.send_request("GET", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=True, retries=retries, circuit_breaker=circuit_breaker)
+
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records, diff_key)
+
+    def POST(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, body_file_id="", multipart_field="", max_inline_bytes="", max_response_bytes="", decoding="", parse_as="", record_tag="", max_records=0):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
         parsed_headers["User-Agent"] = "Shuffle Automation"
         verify = self.checkverify(verify)
-        body = self.checkbody(body)
+        if body_file_id:
+            # Streams the file as the body, so it is never loaded into memory
+            body, content_type = self.file_body(body_file_id, multipart_field)
+            if body == None:
+                return json.dumps({"success": False, "error": "Failed to get file %s" % body_file_id})
+
+            if multipart_field or not any(key.lower() == "content-type" for key in parsed_headers):
+                parsed_headers["Content-Type"] = content_type
+
+            # A streamed body can only be sent once
+            retries = 0
+        else:
+            body = self.checkbody(body)
+
         proxies = {} 
         if http_proxy: 
             proxies["http"] = http_proxy
@@ -228,29 +2140,45 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.post(url, headers=parsed_headers, auth=auth, data=body, verify=verify, proxies=proxies, timeout=timeout)
-        if not to_file:
-            return self.prepare_response(request)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
 
-        return self.return_file(request.text)
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
 
-    def PUT(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+        request = self.send_request("POST", url, headers=parsed_headers, auth=auth, data=body, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing)
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records)
+
+    def PUT(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, body_file_id="", multipart_field="", max_inline_bytes="", max_response_bytes="", decoding="", parse_as="", record_tag="", max_records=0):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
         parsed_headers["User-Agent"] = "Shuffle Automation"
         verify = self.checkverify(verify)
-        body = self.checkbody(body)
+        if body_file_id:
+            # Streams the file as the body, so it is never loaded into memory
+            body, content_type = self.file_body(body_file_id, multipart_field)
+            if body == None:
+                return json.dumps({"success": False, "error": "Failed to get file %s" % body_file_id})
+
+            if multipart_field or not any(key.lower() == "content-type" for key in parsed_headers):
+                parsed_headers["Content-Type"] = content_type
+
+            # A streamed body can only be sent once
+            retries = 0
+        else:
+            body = self.checkbody(body)
+
         proxies = {}
         if http_proxy: 
             proxies["http"] = http_proxy
@@ -267,29 +2195,45 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.put(url, headers=parsed_headers, auth=auth, data=body, verify=verify, proxies=proxies, timeout=timeout)
-        if not to_file:
-            return self.prepare_response(request)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
+
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
 
-        return self.return_file(request.text)
+        request = self.send_request("PUT", url, headers=parsed_headers, auth=auth, data=body, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing)
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records)
 
-    def PATCH(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+    def PATCH(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, body_file_id="", multipart_field="", max_inline_bytes="", max_response_bytes="", decoding="", parse_as="", record_tag="", max_records=0):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
         parsed_headers["User-Agent"] = "Shuffle Automation"
         verify = self.checkverify(verify)
-        body = self.checkbody(body)
+        if body_file_id:
+            # Streams the file as the body, so it is never loaded into memory
+            body, content_type = self.file_body(body_file_id, multipart_field)
+            if body == None:
+                return json.dumps({"success": False, "error": "Failed to get file %s" % body_file_id})
+
+            if multipart_field or not any(key.lower() == "content-type" for key in parsed_headers):
+                parsed_headers["Content-Type"] = content_type
+
+            # A streamed body can only be sent once
+            retries = 0
+        else:
+            body = self.checkbody(body)
+
         proxies = {}
         if http_proxy: 
             proxies["http"] = http_proxy
@@ -305,23 +2249,26 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.patch(url, headers=parsed_headers, data=body, auth=auth, verify=verify, proxies=proxies, timeout=timeout)
-        if not to_file:
-            return self.prepare_response(request)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
 
-        return self.return_file(request.text)
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
 
-    def DELETE(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+        request = self.send_request("PATCH", url, headers=parsed_headers, data=body, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing)
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records)
+
+    def DELETE(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, max_inline_bytes="", max_response_bytes="", decoding="", parse_as="", record_tag="", max_records=0):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
@@ -343,23 +2290,26 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.delete(url, headers=parsed_headers, data=body, auth=auth, verify=verify, proxies=proxies, timeout=timeout)
-        if not to_file:
-            return self.prepare_response(request)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
+
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
 
-        return self.return_file(request.text)
+        request = self.send_request("DELETE", url, headers=parsed_headers, data=body, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing)
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records)
 
-    def HEAD(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+    def HEAD(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, hedge="", decoding=""):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
@@ -381,23 +2331,20 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.head(url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout)
+        request = self.send_request("HEAD", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, allow_redirects=False, stream=to_file, retries=retries, circuit_breaker=circuit_breaker, timing=timing, hedge=hedge)
         if not to_file:
-            return self.prepare_response(request)
+            return self.prepare_response(request, raw_json, select, include_headers, include_cookies, decoding)
 
-        return self.return_file(request.text)
+        return self.return_file(request)
 
-    def OPTIONS(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False):
+    def OPTIONS(self, url, headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, to_file=False, raw_json=False, retries=0, circuit_breaker=False, timing=False, select="", include_headers=True, include_cookies=True, max_inline_bytes="", max_response_bytes="", hedge="", decoding="", parse_as="", record_tag="", max_records=0):
         url = self.fix_url(url)
 
         parsed_headers = self.splitheaders(headers)
@@ -419,23 +2366,745 @@ class HTTP(AppBase):
             else: 
                 auth = requests.auth.HTTPBasicAuth(username, password)
 
-        if not timeout:
-            timeout = 5
-        
-        if timeout:
-            timeout = int(timeout)
+        timeout = self.parse_timeout(timeout)
 
         if to_file == "true":
             to_file = True
         else:
             to_file = False 
 
-        request = requests.options(url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout)
+        max_inline_bytes = self.parse_size(max_inline_bytes, MAX_INLINE_BYTES)
+        max_response_bytes = self.parse_size(max_response_bytes, MAX_RESPONSE_BYTES)
+        parse_as = str(parse_as).lower().strip() if parse_as else ""
+        if parse_as not in ["", "csv", "ndjson", "xml"]:
+            return json.dumps({"success": False, "error": "parse_as should be one of csv, ndjson or xml"})
+
+        max_records = int(max_records) if max_records else 0
+        stream = to_file or max_inline_bytes > 0 or max_response_bytes > 0 or parse_as != ""
+
+        request = self.send_request("OPTIONS", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, stream=stream, retries=retries, circuit_breaker=circuit_breaker, timing=timing, hedge=hedge)
+        return self.respond(request, to_file, raw_json, select, include_headers, include_cookies, max_inline_bytes, max_response_bytes, decoding, parse_as, record_tag, max_records)
+
+
+    def run_batch_item(self, index, item, auth, verify, proxies, timeout, retries=0, circuit_breaker=False):
+        start = time.time()
+        try:
+            if isinstance(item, str):
+                item = {"url": item}
+
+            method = str(item.get("method", "GET")).upper().strip()
+            url = self.fix_url(item["url"])
+
+            headers = item.get("headers", "")
+            if isinstance(headers, dict):
+                parsed_headers = {str(key): str(value) for key, value in headers.items()}
+            else:
+                parsed_headers = self.splitheaders(headers)
+            parsed_headers["User-Agent"] = "Shuffle Automation"
+
+            # Shouldn't be used if authorization headers exist
+            if "Authorization" in parsed_headers:
+                auth = None
+
+            body = self.checkbody(item.get("body", ""))
+            request = self.send_capped(method, url, headers=parsed_headers, auth=auth, data=body, verify=verify, proxies=proxies, timeout=timeout, allow_redirects=method != "HEAD", retries=retries, circuit_breaker=circuit_breaker)
+
+            parseddata = self.parse_response(request)
+        except Exception as e:
+            parseddata = {
+                "success": False,
+                "error": str(e),
+            }
+
+        parseddata["index"] = index
+        parseddata["elapsed_ms"] = int((time.time() - start) * 1000)
+        return parseddata
+
+    def BATCH(self, request_list, concurrency=10, username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, retries=0, circuit_breaker=False):
+        try:
+            request_list = self.loadparam(request_list)
+        except Exception as e:
+            return json.dumps({"success": False, "error": f"Invalid request list: {e}"})
+
+        if isinstance(request_list, dict):
+            request_list = [request_list]
+
+        if not isinstance(request_list, list):
+            return json.dumps({"success": False, "error": "The request list should be a list of objects with method, url, headers and body"})
+
+        verify = self.checkverify(verify)
+        proxies = {}
+        if http_proxy: 
+            proxies["http"] = http_proxy
+        if https_proxy: 
+            proxies["https"] = https_proxy
+
+        auth=None
+        if username or password:
+            auth = requests.auth.HTTPBasicAuth(username, password)
+
+        timeout = self.parse_timeout(timeout)
+
+        start = time.time()
+        results = self.run_concurrently(
+            lambda indexed: self.run_batch_item(indexed[0], indexed[1], auth, verify, proxies, timeout, retries, circuit_breaker),
+            list(enumerate(request_list)),
+            concurrency,
+        )
+
+        return json.dumps({
+            "success": True,
+            "total": len(results),
+            "failed": len([result for result in results if not result["success"]]),
+            "elapsed_ms": int((time.time() - start) * 1000),
+            "results": results,
+        })
+
+    def render_template(self, template, variables, escape=None):
+        # Raises ValueError when a placeholder has no value
+        def replace(match):
+            value = self.get_json_path(variables, match.group(1))
+            if value == None:
+                raise ValueError("No value for ${%s}" % match.group(1))
+
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            elif isinstance(value, bool):
+                value = str(value).lower()
+
+            value = str(value)
+            return escape(value) if escape else value
+
+        return template_placeholder.sub(replace, template)
+
+    def run_template_item(self, index, variables, method, url, headers, body, select="", **kwargs):
+        start = time.time()
+        try:
+            if not isinstance(variables, dict):
+                variables = {"value": variables}
+
+            # Values are encoded for where they are used in the request
+            item_url = self.render_template(url, variables, lambda value: urllib.parse.quote(value, safe=""))
+            item_headers = {key: self.render_template(value, variables) for key, value in headers.items()}
+            # JSON bodies come from checkbody as bytes
+            item_body = body
+            text = body.decode("utf-8") if isinstance(body, bytes) else body
+            if isinstance(text, str) and "${" in text:
+                escape = (lambda value: json.dumps(value)[1:-1]) if re.match(r"\s*[\[{]", text) else None
+                item_body = self.render_template(text, variables, escape).encode("utf-8")
+
+            request = self.send_capped(method, item_url, headers=item_headers, data=item_body, allow_redirects=method != "HEAD", **kwargs)
+            parseddata = self.parse_response(request, select=select, include_headers=False, include_cookies=False)
+            parseddata = {
+                "status": parseddata["status"],
+                "body": parseddata["body"],
+                "success": parseddata["success"],
+            }
+        except Exception as e:
+            parseddata = {
+                "success": False,
+                "error": str(e),
+            }
+
+        parseddata["index"] = index
+        parseddata["elapsed_ms"] = int((time.time() - start) * 1000)
+        return parseddata
+
+    def TEMPLATE_FANOUT(self, url, variables, method="GET", headers="", body="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, concurrency=10, select="", retries=0, circuit_breaker=False):
+        try:
+            variables = self.loadparam(variables)
+        except Exception as e:
+            return json.dumps({"success": False, "error": f"Invalid variables: {e}"})
+
+        if isinstance(variables, dict):
+            variables = [variables]
+
+        if not isinstance(variables, list):
+            return json.dumps({"success": False, "error": "The variables should be a list of objects, or a list of values used as ${value}"})
+
+        method = str(method).upper().strip() if method else "GET"
+
+        # Everything which is the same for each request is only set up once
+        url = self.fix_url(url)
+        parsed_headers = self.splitheaders(headers)
+        parsed_headers["User-Agent"] = "Shuffle Automation"
+        body = self.checkbody(body) if body else None
+        verify = self.checkverify(verify)
+
+        proxies = {}
+        if http_proxy: 
+            proxies["http"] = http_proxy
+        if https_proxy: 
+            proxies["https"] = https_proxy
+
+        auth=None
+        if username or password:
+            # Shouldn't be used if authorization headers exist
+            if "Authorization" not in parsed_headers:
+                auth = requests.auth.HTTPBasicAuth(username, password)
+
+        timeout = self.parse_timeout(timeout)
+
+        start = time.time()
+        results = self.run_concurrently(
+            lambda indexed: self.run_template_item(indexed[0], indexed[1], method, url, parsed_headers, body, select, auth=auth, verify=verify, proxies=proxies, timeout=timeout, retries=retries, circuit_breaker=circuit_breaker),
+            list(enumerate(variables)),
+            concurrency,
+        )
+
+        return json.dumps({
+            "success": True,
+            "total": len(results),
+            "failed": len([result for result in results if not result["success"]]),
+            "elapsed_ms": int((time.time() - start) * 1000),
+            "results": results,
+        })
+
+    def bulk_records(self, records, file_id=""):
+        """
+        Yields the records one at a time, from a list or a Shuffle file with
+        a JSON list or NDJSON. NDJSON lines are passed on as they are.
+        """
+        if not file_id:
+            if isinstance(records, str):
+                try:
+                    records = self.loadparam(records)
+                except (ValueError, SyntaxError):
+                    records = records.splitlines()
+
+            if isinstance(records, dict):
+                records = [records]
+
+            for record in records:
+                yield record
+
+            return
+
+        filename, content = self.open_file(file_id)
+        if not content:
+            raise ValueError("Failed to get file %s" % file_id)
+
+        try:
+            lines = content.iter_lines(chunk_size=STREAM_CHUNK_SIZE)
+            for line in lines:
+                if not line.strip():
+                    continue
+
+                # A JSON list has to be loaded as a whole
+                if line.lstrip().startswith(b"["):
+                    for record in json.loads(b"\n".join([line] + list(lines))):
+                        yield record
+
+                    return
+
+                yield line.decode("utf-8", errors="replace")
+        finally:
+            content.close()
+
+    def bulk_chunks(self, records, action_line="", max_bytes=0, max_records=0):
+        # Serializes the records to NDJSON as they are read, and yields
+        # (first record index, lines) for each chunk
+        prefix = ("%s\n" % action_line.strip()).encode() if action_line.strip() else b""
+        chunk = []
+        size = 0
+        first = 0
+        index = -1
+        for record in records:
+            if isinstance(record, str):
+                record = record.strip()
+                if not record:
+                    continue
+            else:
+                record = json.dumps(record)
+
+            index += 1
+            line = prefix + record.encode() + b"\n"
+            if chunk and ((max_bytes and size + len(line) > max_bytes) or (max_records and len(chunk) >= max_records)):
+                yield first, chunk
+                chunk = []
+                size = 0
+
+            if not chunk:
+                first = index
+
+            chunk.append(line)
+            size += len(line)
+
+        if chunk:
+            yield first, chunk
+
+    def bulk_errors(self, request, first, count):
+        # Errors for each record in Elasticsearch style responses, or for the
+        # whole chunk otherwise (Splunk HEC sends a non-zero code)
+        try:
+            body = request.json()
+        except ValueError:
+            body = None
+
+        errors = []
+        if isinstance(body, dict) and body.get("errors") and isinstance(body.get("items"), list):
+            for position, item in enumerate(body["items"]):
+                result = list(item.values())[0] if isinstance(item, dict) and item else {}
+                if not isinstance(result, dict):
+                    continue
+
+                status = result.get("status", 200)
+                if "error" in result or (isinstance(status, int) and status >= 300):
+                    errors.append({"record": first + position, "status": status, "error": result.get("error")})
+        elif request.status_code >= 300 or (isinstance(body, dict) and body.get("code", 0) not in [0, None]):
+            error = body.get("text", body) if isinstance(body, dict) else self.decode_body(request)[:1000]
+            errors.append({"record": first, "records": count, "status": request.status_code, "error": error})
+
+        return errors
+
+    def send_bulk_chunk(self, url, first, lines, **kwargs):
+        try:
+            request = self.send_capped("POST", url, data=b"".join(lines), **kwargs)
+        except (requests.exceptions.RequestException, ResponseTooLarge) as e:
+            return {"first": first, "records": len(lines), "status": 0, "errors": [{"record": first, "records": len(lines), "status": 0, "error": str(e)}]}
+
+        errors = self.bulk_errors(request, first, len(lines))
+        return {"first": first, "records": len(lines), "status": request.status_code, "errors": errors}
+
+    def BULK_POST(self, url, records="", file_id="", headers="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=30, action_line="", chunk_bytes="5MB", chunk_records=1000, concurrency=4, retries=0, circuit_breaker=False):
+        url = self.fix_url(url)
+
+        parsed_headers = self.splitheaders(headers)
+        parsed_headers["User-Agent"] = "Shuffle Automation"
+        if not any(key.lower() == "content-type" for key in parsed_headers):
+            parsed_headers["Content-Type"] = "application/x-ndjson"
+
+        verify = self.checkverify(verify)
+        proxies = {}
+        if http_proxy: 
+            proxies["http"] = http_proxy
+        if https_proxy: 
+            proxies["https"] = https_proxy
+
+        auth=None
+        if username or password:
+            # Shouldn't be used if authorization headers exist
+            if "Authorization" not in parsed_headers:
+                auth = requests.auth.HTTPBasicAuth(username, password)
+
+        timeout = self.parse_timeout(timeout, 30)
+
+        if not records and not file_id:
+            return json.dumps({"success": False, "error": "Either records or a file_id is required"})
+
+        chunk_bytes = self.parse_size(chunk_bytes, 5*1024*1024)
+        try:
+            chunk_records = int(chunk_records) if chunk_records else 0
+            concurrency = max(1, int(concurrency)) if concurrency else 4
+        except ValueError:
+            return json.dumps({"success": False, "error": "chunk_records and concurrency should be numbers"})
+
+        start = time.time()
+        results = []
+        pending = set()
+
+        # Only a few chunks are kept in memory at a time, as they are built while
+        # earlier ones are sent
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            chunks = self.bulk_chunks(self.bulk_records(records, file_id), action_line, chunk_bytes, chunk_records)
+            for first, lines in chunks:
+                if len(pending) >= concurrency:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    results.extend([future.result() for future in done])
+
+                pending.add(executor.submit(self.send_bulk_chunk, url, first, lines, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, retries=retries, circuit_breaker=circuit_breaker))
+
+            results.extend([future.result() for future in concurrent.futures.as_completed(pending)])
+        except (ValueError, SyntaxError) as e:
+            return json.dumps({"success": False, "error": f"Invalid records: {e}"})
+        finally:
+            executor.shutdown(wait=True)
+
+        results.sort(key=lambda result: result["first"])
+        errors = [error for result in results for error in result["errors"]]
+        failed_records = sum([error.get("records", 1) for error in errors])
+
+        return json.dumps({
+            "success": len(errors) == 0,
+            "records": sum([result["records"] for result in results]),
+            "chunks": len(results),
+            "failed_chunks": len([result for result in results if result["errors"]]),
+            "failed_records": failed_records,
+            "elapsed_ms": int((time.time() - start) * 1000),
+            "errors": errors[:BULK_MAX_ERRORS],
+        })
+
+    def GET_ALL_PAGES(self, url, headers="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=5, pagination="link", items_path="", page_size=100, offset_param="offset", limit_param="limit", cursor_path="", cursor_param="cursor", max_pages=10, max_items=0, to_file=False, retries=0):
+        url = self.fix_url(url)
+
+        parsed_headers = self.splitheaders(headers)
+        parsed_headers["User-Agent"] = "Shuffle Automation"
+        verify = self.checkverify(verify)
+
+        proxies = {}
+        if http_proxy: 
+            proxies["http"] = http_proxy
+        if https_proxy: 
+            proxies["https"] = https_proxy
+
+        auth=None
+        if username or password:
+            # Shouldn't be used if authorization headers exist
+            if "Authorization" not in parsed_headers:
+                auth = requests.auth.HTTPBasicAuth(username, password)
+
+        timeout = self.parse_timeout(timeout)
+
+        pagination = str(pagination).lower().strip()
+        if pagination not in ["link", "offset", "page", "cursor"]:
+            return json.dumps({"success": False, "error": "Pagination should be one of link, offset, page or cursor"})
+
+        if pagination == "cursor" and not cursor_path:
+            return json.dumps({"success": False, "error": "A cursor_path is required for cursor pagination"})
+
+        page_size = int(page_size) if page_size else 100
+        max_pages = int(max_pages) if max_pages else 10
+        max_items = int(max_items) if max_items else 0
+        to_file = str(to_file).lower() == "true"
+
+        # Offsets and pages continue from the url if it already has one
+        offset = 0
+        if pagination == "page":
+            offset = 1
+        if pagination in ["offset", "page"]:
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+            try:
+                offset = int(query.get(offset_param, offset))
+            except ValueError:
+                pass
+
+            url = self.set_query_param(url, offset_param, offset)
+            url = self.set_query_param(url, limit_param, page_size)
+
+        def fetch(page_url):
+            return self.send_capped("GET", page_url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=timeout, retries=retries)
+
+        def discard(future):
+            # Closes a prefetched page which turned out not to be needed
+            future.add_done_callback(lambda done: done.exception() or done.result().close())
+
+        items = []
+        spooled = SpooledFile() if to_file else None
+        item_count = 0
+        pages = 0
+        next_url = ""
+        resume_url = ""
+        error = ""
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        next_future = executor.submit(fetch, url)
+        try:
+            while next_future:
+                try:
+                    request = next_future.result()
+                except (ResponseTooLarge, requests.exceptions.RequestException) as e:
+                    # The items so far are still returned, with the failed page as next
+                    error = "Page %d: %s" % (pages+1, e)
+                    resume_url = next_url or url
+                    next_future = None
+                    break
+
+                next_future = None
+                pages += 1
+
+                if request.status_code >= 300:
+                    error = "Got status %d for %s" % (request.status_code, request.url)
+                    break
+
+                # The next page is fetched while this one is parsed when its url
+                # doesn't depend on the body
+                next_url = ""
+                if pagination == "link":
+                    next_url = request.links.get("next", {}).get("url", "")
+                    if next_url:
+                        next_url = urllib.parse.urljoin(request.url, next_url)
+                elif pagination == "offset":
+                    # Assumes a full page, which is checked once the page is parsed
+                    next_url = self.set_query_param(request.url, offset_param, offset + page_size)
+                elif pagination == "page":
+                    next_url = self.set_query_param(request.url, offset_param, offset + 1)
+
+                if next_url and pages < max_pages:
+                    next_future = executor.submit(fetch, next_url)
+
+                try:
+                    body = json.loads(self.decode_body(request))
+                except json.decoder.JSONDecodeError as e:
+                    error = "Page %d is not valid JSON: %s" % (pages, e)
+                    break
+
+                if items_path:
+                    page_items = self.get_json_path(body, items_path)
+                elif isinstance(body, dict):
+                    page_items = next((value for value in body.values() if isinstance(value, list)), None)
+                else:
+                    page_items = body
+
+                if page_items == None:
+                    page_items = []
+                elif not isinstance(page_items, list):
+                    page_items = [page_items]
+
+                if pagination == "cursor":
+                    cursor = self.get_json_path(body, cursor_path)
+                    next_url = self.set_query_param(request.url, cursor_param, cursor) if cursor else ""
+                    if next_url and pages < max_pages:
+                        next_future = executor.submit(fetch, next_url)
+                elif pagination == "offset":
+                    # Servers often cap the limit, so the offset moves by the
+                    # items actually returned
+                    offset += len(page_items)
+                    actual_url = self.set_query_param(request.url, offset_param, offset)
+                    if actual_url != next_url:
+                        if next_future:
+                            discard(next_future)
+                            next_future = None
+
+                        next_url = actual_url
+                        if page_items and pages < max_pages:
+                            next_future = executor.submit(fetch, next_url)
+                elif pagination == "page":
+                    offset += 1
+
+                # Short pages don't mean the end, as the page size may be capped,
+                # so offsets and pages stop on an empty page
+                if pagination in ["offset", "page"] and not page_items:
+                    next_url = ""
+
+                if max_items and item_count + len(page_items) >= max_items:
+                    page_items = page_items[:max_items-item_count]
+
+                for item in page_items:
+                    if to_file:
+                        spooled.write((json.dumps(item) + "\n").encode())
+                    else:
+                        items.append(item)
+
+                item_count += len(page_items)
+                if not next_url or not page_items or (max_items and item_count >= max_items) or pages >= max_pages:
+                    break
+        finally:
+            if next_future:
+                discard(next_future)
+
+            executor.shutdown(wait=False)
+
+        # next is set when the page or item cap was hit before the last page,
+        # or to the page which couldn't be fetched
+        parseddata = {
+            "success": not error,
+            "pages": pages,
+            "count": item_count,
+            "next": next_url if next_url and not error else resume_url,
+        }
+
+        if error:
+            parseddata["error"] = error
+
         if not to_file:
+            parseddata["items"] = items
+            return json.dumps(parseddata)
+
+        fileret = self.upload_spooled("pages.ndjson", spooled)
+        parseddata.update(fileret)
+        parseddata["success"] = fileret["success"] and not error
+        return json.dumps(parseddata)
+
+    def iter_stream(self, request):
+        # Yields data as soon as it arrives, instead of waiting for a full chunk
+        read1 = getattr(request.raw, "read1", None)
+        if read1 == None:
+            for data in request.iter_content(chunk_size=None):
+                yield data
+
+            return
+
+        while True:
+            data = read1(STREAM_CHUNK_SIZE, decode_content=True)
+            if not data:
+                return
+
+            yield data
+
+    def split_lines(self, chunks):
+        # Splits on \r\n, \n and \r as they arrive, keeping partial lines
+        buffer = ""
+        for chunk in chunks:
+            buffer += chunk.decode("utf-8", errors="replace")
+            lines = re.split(r"\r\n|\r|\n", buffer)
+
+            # A trailing \r might be the start of \r\n
+            buffer = lines.pop()
+            if buffer == "" and lines and chunk.endswith(b"\r"):
+                buffer = "\r"
+
+            for line in lines:
+                yield line
+
+    def parse_sse(self, lines):
+        # Server-Sent Events, as described in the HTML living standard
+        event = {}
+        data = []
+        for line in lines:
+            line = line.lstrip("\r")
+            if line == "":
+                if data:
+                    event["data"] = self.loadevent("\n".join(data))
+                    yield event
+
+                event = {}
+                data = []
+                continue
+
+            if line.startswith(":"):
+                continue
+
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+
+            if field == "data":
+                data.append(value)
+            elif field in ["event", "id"]:
+                event[field] = value
+
+    def loadevent(self, data):
+        if re.match(r"\s*[\[{]", data):
+            try:
+                return json.loads(data)
+            except ValueError:
+                pass
+
+        return data
+
+    def STREAM(self, url, headers="", username="", password="", verify=True, http_proxy="", https_proxy="", timeout=30, stream_format="auto", max_events=100, max_bytes="10MB", duration=60, last_event_id="", to_file=False):
+        url = self.fix_url(url)
+
+        parsed_headers = self.splitheaders(headers)
+        parsed_headers["User-Agent"] = "Shuffle Automation"
+        verify = self.checkverify(verify)
+
+        proxies = {}
+        if http_proxy: 
+            proxies["http"] = http_proxy
+        if https_proxy: 
+            proxies["https"] = https_proxy
+
+        auth=None
+        if username or password:
+            # Shouldn't be used if authorization headers exist
+            if "Authorization" not in parsed_headers:
+                auth = requests.auth.HTTPBasicAuth(username, password)
+
+        timeout = self.parse_timeout(timeout, 30)
+        if timeout == "adaptive":
+            timeout = 30
+
+        stream_format = str(stream_format).lower().strip() if stream_format else "auto"
+        if stream_format not in ["auto", "sse", "lines"]:
+            return json.dumps({"success": False, "error": "stream_format should be one of auto, sse or lines"})
+
+        if stream_format == "sse" and not any(key.lower() == "accept" for key in parsed_headers):
+            parsed_headers["Accept"] = "text/event-stream"
+        if last_event_id:
+            parsed_headers["Last-Event-ID"] = str(last_event_id)
+
+        try:
+            max_events = int(max_events) if max_events else 0
+            duration = float(duration) if duration else 60
+        except ValueError:
+            return json.dumps({"success": False, "error": "max_events and duration should be numbers"})
+
+        max_bytes = self.parse_size(max_bytes, 10*1024*1024)
+        to_file = str(to_file).lower() == "true"
+
+        # The read timeout also ends the stream when nothing has arrived for a while
+        deadline = time.time() + duration
+        request = self.send_request("GET", url, headers=parsed_headers, auth=auth, verify=verify, proxies=proxies, timeout=(timeout, min(timeout, duration)), stream=True)
+        if request.status_code >= 300:
             return self.prepare_response(request)
 
-        return self.return_file(request.text)
+        if stream_format == "auto":
+            mimetype = request.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            stream_format = "sse" if mimetype == "text/event-stream" else "lines"
+
+        events = []
+        spooled = SpooledFile() if to_file else None
+        state = {"bytes": 0, "stopped": ""}
+        count = 0
+        stopped = ""
+        error = ""
+
+        # Checked between reads, so comments and heartbeats can't keep it going
+        def limited(chunks):
+            for chunk in chunks:
+                state["bytes"] += len(chunk)
+                yield chunk
+
+                if max_bytes and state["bytes"] >= max_bytes:
+                    state["stopped"] = "max_bytes"
+                    return
+                if time.time() >= deadline:
+                    state["stopped"] = "deadline"
+                    return
+
+        lines = self.split_lines(limited(self.iter_stream(request)))
+        if stream_format == "sse":
+            parsed = self.parse_sse(lines)
+        else:
+            parsed = ({"data": self.loadevent(line)} for line in lines if line.strip())
+
+        try:
+            for event in parsed:
+                if "id" in event:
+                    last_event_id = event["id"]
+
+                if to_file:
+                    spooled.write((json.dumps(event) + "\n").encode())
+                else:
+                    events.append(event)
+
+                count += 1
+                if max_events and count >= max_events:
+                    stopped = "max_events"
+                    break
+        except (requests.exceptions.ConnectionError, urllib3.exceptions.ReadTimeoutError, socket.timeout) as e:
+            if "timed out" in str(e).lower() or isinstance(e, (urllib3.exceptions.ReadTimeoutError, socket.timeout)):
+                stopped = "deadline" if time.time() >= deadline else "idle"
+            else:
+                error = str(e)
+        except (urllib3.exceptions.HTTPError, requests.exceptions.RequestException) as e:
+            error = str(e)
+        finally:
+            request.close()
+
+        parseddata = {
+            "success": not error,
+            "status": request.status_code,
+            "url": request.url,
+            "count": count,
+            "bytes": state["bytes"],
+            "stopped": stopped or state["stopped"] or "closed",
+            "last_event_id": last_event_id,
+        }
+
+        if error:
+            parseddata["error"] = error
+
+        if not to_file:
+            parseddata["events"] = events
+            return json.dumps(parseddata)
 
+        fileret = self.upload_spooled("events.ndjson", spooled)
+        parseddata.update(fileret)
+        parseddata["success"] = fileret["success"] and not error
+        return json.dumps(parseddata)
 
 # Run the actual thing after we've checked params
 def run(request):